@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Performance Benchmark Script
+Run this locally to measure the template generation engine
+
+Usage:
+    python benchmark.py
+    python benchmark.py --size 1600
+    python benchmark.py --scaling
+"""
+
+import sys
+import time
+import argparse
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import cv2
+
+sys.path.insert(0, str(Path(__file__).parent / "src"))
+
+import color_by_number as cbn  # noqa: E402
+
+
+def make_test_image(size, seed=0, blob=40):
+    """Smooth photo-like test image with noise; smaller blob means more detail"""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (max(2, size // blob), max(2, size // blob), 3), dtype=np.uint8)
+    img = cv2.resize(small, (size, size), interpolation=cv2.INTER_CUBIC)
+    noise = rng.normal(0, 6, img.shape)
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+
+def posterize(img, levels=8):
+    """Flat-color version of a test image, like a scan or illustration"""
+    step = 256 // levels
+    return (img // step * step + step // 2).astype(np.uint8)
+
+
+def bench_quantize(img, n_colors, label=""):
+    print(f"\n📊 Quantization{label} ({img.shape[1]}x{img.shape[0]}, {n_colors} colors)")
+    for mode in cbn.QUANTIZE_MODES:
+        for bits in cbn.HISTOGRAM_BITS if mode == "histogram" else (8,):
+            _, _, stats = cbn.quantize_image(img, n_colors, mode, bits=bits)
+            print(f"   {cbn.format_quantize_stats(stats)}")
+
+
+def legacy_exact_palette(pixels, labels, cluster_centers, n_colors):
+    """Original per-cluster Counter implementation, kept for comparison"""
+    cluster_centers = cluster_centers.astype(int)
+    palette = {}
+    for i in range(n_colors):
+        cluster_pixels = pixels[labels == i]
+        if len(cluster_pixels) == 0:
+            palette[i + 1] = tuple(cluster_centers[i])
+            continue
+        color_counts = Counter(tuple(p) for p in cluster_pixels)
+        top_colors = color_counts.most_common(min(10, len(color_counts)))
+        centroid = cluster_centers[i]
+        best_color = top_colors[0][0]
+        best_dist = float('inf')
+        most_common_count = top_colors[0][1]
+        for color, count in top_colors:
+            dist = np.sqrt(sum((int(c1) - int(c2)) ** 2 for c1, c2 in zip(color, centroid)))
+            if count > most_common_count * 0.5 and dist < best_dist:
+                best_dist = dist
+                best_color = color
+        median_color = tuple(np.median(cluster_pixels, axis=0).astype(int))
+        best_sat = int(max(best_color)) - int(min(best_color))
+        median_sat = max(median_color) - min(median_color)
+        final = median_color if median_sat > best_sat * 1.2 else best_color
+        palette[i + 1] = tuple(int(c) for c in final)
+    return palette
+
+
+def bench_palette(img, n_colors):
+    print(f"\n🎨 Exact palette selection ({img.shape[1]}x{img.shape[0]})")
+    pixels = img.reshape(-1, 3)
+    labels, centers, _ = cbn.quantize_image(img, n_colors, "fast")
+
+    start = time.perf_counter()
+    legacy = legacy_exact_palette(pixels, labels, centers, n_colors)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    palette, _ = cbn.select_palette_colors(pixels, labels, centers, n_colors, True)
+    fast_time = time.perf_counter() - start
+
+    match = "✅ identical" if palette == legacy else "❌ MISMATCH"
+    print(f"   Counter: {legacy_time:.3f}s | vectorized: {fast_time:.3f}s "
+          f"| {legacy_time / max(fast_time, 1e-9):.0f}x | {match}")
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float32) - b.astype(np.float32)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def bench_prefilter(img, n_colors, min_size=30):
+    print(f"\n🧼 Prefilter strategies ({img.shape[1]}x{img.shape[0]}, PSNR vs bilateral)")
+    reference = cbn.prefilter_image(img, "bilateral")
+    for mode in cbn.PREFILTER_MODES:
+        start = time.perf_counter()
+        filtered = cbn.prefilter_image(img, mode)
+        elapsed = time.perf_counter() - start
+
+        labels, _, _ = cbn.quantize_image(filtered, n_colors, "fast", trace_memory=False)
+        regions = cbn.create_regions(labels.reshape(img.shape[:2]), n_colors, min_size)
+        print(f"   {mode:16s} {elapsed:7.3f}s | PSNR {psnr(filtered, reference):6.1f}dB "
+              f"| {len(regions):6d} regions")
+
+
+def bench_regions(img, n_colors, min_size=30):
+    print(f"\n🧩 Region store ({img.shape[1]}x{img.shape[0]}, min size {min_size})")
+    filtered = cbn.prefilter_image(img)
+    labels, _, _ = cbn.quantize_image(filtered, n_colors, "fast")
+    labels = labels.reshape(img.shape[:2])
+
+    start = time.perf_counter()
+    regions = cbn.create_regions(labels, n_colors, min_size)
+    elapsed = time.perf_counter() - start
+
+    legacy_bytes = len(regions) * labels.size  # one full-size bool mask per region
+    print(f"   {len(regions)} regions in {elapsed:.3f}s")
+    print(f"   store: {regions.nbytes / 1e6:.1f}MB | per-region masks: {legacy_bytes / 1e6:.1f}MB "
+          f"| {legacy_bytes / max(regions.nbytes, 1):.0f}x smaller")
+
+
+def bench_region_scaling(n_colors=20, min_size=10):
+    print(f"\n📈 Region extraction scaling ({n_colors} colors, min size {min_size})")
+    for size in (500, 1000, 2000):
+        img = make_test_image(size, blob=8)
+        labels, _, _ = cbn.quantize_image(cbn.prefilter_image(img), n_colors, "fast")
+        labels = labels.reshape(img.shape[:2])
+
+        start = time.perf_counter()
+        regions = cbn.fill_remaining_holes(cbn.create_regions(labels, n_colors, min_size), labels)
+        elapsed = time.perf_counter() - start
+
+        print(f"   {size}x{size}: {len(regions):6d} regions in {elapsed:.3f}s "
+              f"({elapsed / labels.size * 1e9:.0f} ns/pixel)")
+
+
+def bench_click_latency(n_colors=20, clicks=2000):
+    print(f"\n🖱️  Click hit-test latency ({clicks} random clicks)")
+    rng = np.random.default_rng(0)
+    for size in (250, 500, 1000):
+        img = make_test_image(size, blob=8)
+        labels, _, _ = cbn.quantize_image(cbn.prefilter_image(img), n_colors, "fast")
+        regions = cbn.create_regions(labels.reshape(img.shape[:2]), n_colors, 10)
+        colored_flags = np.zeros(len(regions), dtype=bool)
+        xs = rng.integers(0, size, clicks)
+        ys = rng.integers(0, size, clicks)
+
+        start = time.perf_counter()
+        for x, y in zip(xs, ys):
+            region_id = regions.region_at(x, y)
+            _ = region_id is not None and not colored_flags[region_id]
+        lookup = (time.perf_counter() - start) / clicks
+
+        # Old hit test: scan regions in order, testing each full-size mask;
+        # one shared mask object stands in for all of them to keep memory flat
+        legacy = [{'mask': np.zeros((size, size), dtype=bool)}] * len(regions)
+        start = time.perf_counter()
+        for x, y in zip(xs[:20], ys[:20]):
+            for region_info in legacy:
+                if region_info['mask'][y, x]:
+                    break
+        scan = (time.perf_counter() - start) / 20
+
+        print(f"   {len(regions):6d} regions: lookup {lookup * 1e6:.1f}us | "
+              f"mask scan {scan * 1e6:.0f}us (worst case)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Color by Number engine")
+    parser.add_argument("--size", type=int, default=800,
+                        help="Test image width/height in pixels")
+    parser.add_argument("--colors", type=int, default=12,
+                        help="Number of palette colors")
+    parser.add_argument("--scaling", action="store_true",
+                        help="Also run region extraction on 500-2000px detailed images")
+
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("⏱️  Color by Number - Benchmark")
+    print("=" * 60)
+
+    img = make_test_image(args.size)
+    bench_quantize(img, args.colors)
+    bench_quantize(posterize(img), args.colors, " of posterized image")
+    bench_palette(img, args.colors)
+    bench_regions(img, args.colors)
+    bench_prefilter(img, args.colors)
+    bench_click_latency()
+    if args.scaling:
+        bench_region_scaling()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,25 +10,2169 @@ else:
     application_path = os.path.dirname(os.path.abspath(__file__))
 
 import customtkinter as ctk
-from tkinter import filedialog, messagebox
+from tkinter import filedialog, messagebox, colorchooser
 import tkinter as tk
-from PIL import Image, ImageTk, ImageDraw, ImageFont
+from PIL import Image, ImageTk, ImageDraw, ImageFont, GifImagePlugin
 import numpy as np
 from sklearn.cluster import KMeans
-from collections import defaultdict, Counter
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 from scipy import ndimage
+from scipy.spatial import cKDTree
 import json
+import io
+import hashlib
 import random
 import time
+import tracemalloc
+import threading
+import queue
+import shutil
+import tempfile
+import multiprocessing
+from multiprocessing import shared_memory
 from datetime import datetime
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 # Set appearance and theme
 ctk.set_appearance_mode("dark")
 ctk.set_default_color_theme("blue")
 
 
+# ==================== Quantization Engine ====================
+
+QUANTIZE_MODES = ("exact", "fast", "histogram")
+HISTOGRAM_BITS = (8, 6, 5)
+QUANTIZE_SAMPLE_SIZE = 50000
+QUANTIZE_CHUNK_SIZE = 65536
+QUANTIZE_HISTORY_SIZE = 32
+
+
+def measure_call(func, *args, trace_memory=True):
+    """Run func, returning (result, seconds, peak traced bytes or None)"""
+    if not trace_memory:
+        start = time.perf_counter()
+        result = func(*args)
+        return result, time.perf_counter() - start, None
+
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not already_tracing:
+            tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def stratified_pixel_sample(img_array, sample_size=QUANTIZE_SAMPLE_SIZE, random_state=42):
+    """Pick one random pixel per grid cell so the sample covers the whole image"""
+    height, width = img_array.shape[:2]
+    pixels = img_array.reshape(-1, 3)
+    if height * width <= sample_size:
+        return pixels.astype(np.float32)
+
+    step = max(1, int(np.sqrt(height * width / sample_size)))
+    rng = np.random.default_rng(random_state)
+
+    ys = np.arange(0, height, step)
+    xs = np.arange(0, width, step)
+    cell_y = np.minimum(ys[:, None] + rng.integers(0, step, (len(ys), len(xs))), height - 1)
+    cell_x = np.minimum(xs[None, :] + rng.integers(0, step, (len(ys), len(xs))), width - 1)
+
+    return img_array[cell_y.ravel(), cell_x.ravel()].astype(np.float32)
+
+
+def predict_labels_chunked(pixels, centers, chunk_size=QUANTIZE_CHUNK_SIZE):
+    """Nearest-center labels computed in float32 chunks of bounded size"""
+    centers = np.asarray(centers, dtype=np.float32)
+    center_norms = np.einsum('ij,ij->i', centers, centers)
+    labels = np.empty(len(pixels), dtype=np.int32)
+
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start:start + chunk_size].astype(np.float32)
+        # |p - c|^2 without the |p|^2 term, which does not change the argmin
+        dists = center_norms - 2.0 * (chunk @ centers.T)
+        labels[start:start + chunk_size] = np.argmin(dists, axis=1)
+
+    return labels
+
+
+def color_histogram(pixels, bits=8):
+    """Reduce (N, 3) uint8 pixels to (colors, counts, inverse).
+
+    colors[inverse] reproduces each pixel's color. With bits < 8 every
+    channel is first binned to its top bits, and a bin's color is the mean
+    of the pixels that fell into it rather than the bin corner.
+    """
+    shift = 8 - bits
+    binned = pixels.astype(np.int32) >> shift
+    codes = (binned[:, 0] << (2 * bits)) | (binned[:, 1] << bits) | binned[:, 2]
+
+    if len(codes) >= 1 << (3 * bits):
+        # Dense bincount + lookup table beats np.unique's sort once the
+        # tables are no bigger than the per-pixel arrays
+        code_counts = np.bincount(codes, minlength=1 << (3 * bits))
+        present = np.flatnonzero(code_counts)
+        index = np.zeros(len(code_counts), dtype=np.int32)
+        index[present] = np.arange(len(present), dtype=np.int32)
+        inverse = index[codes]
+        counts = code_counts[present]
+    else:
+        present, inverse, counts = np.unique(codes, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+
+    if shift == 0:
+        colors = np.stack([present >> 16, (present >> 8) & 0xFF, present & 0xFF], axis=1).astype(np.float64)
+    else:
+        colors = np.stack([
+            np.bincount(inverse, weights=pixels[:, c], minlength=len(present)) for c in range(3)
+        ], axis=1) / counts[:, None]
+    return colors, counts, inverse
+
+
+def fit_color_histogram(kmeans, pixels, n_colors, bits):
+    """Fit kmeans on weighted unique colors; returns (labels, centers, n unique)"""
+    colors, counts, inverse = color_histogram(pixels, bits)
+    if len(colors) <= n_colors:
+        # Fewer colors than clusters: every color is its own center, the
+        # rest stay empty
+        padding = np.repeat(colors[-1:], n_colors - len(colors), axis=0)
+        return inverse, np.vstack([colors, padding]), len(colors)
+    kmeans.fit(colors, sample_weight=counts)
+    return kmeans.labels_[inverse], kmeans.cluster_centers_, len(colors)
+
+
+def cluster_summary(pixels, labels, centers):
+    """Per-cluster count, squared error and principal spread of a quantize result.
+
+    This is all warm_start_centers needs, so history can keep a few small
+    arrays per entry instead of a full-size label map.
+    """
+    centers = np.asarray(centers, dtype=np.float64)
+    k = len(centers)
+    labels = labels.ravel()
+    channels = [pixels[:, c].astype(np.float64) for c in range(3)]
+
+    counts = np.bincount(labels, minlength=k).astype(np.float64)
+    safe_counts = np.maximum(counts, 1)
+    means = np.stack([np.bincount(labels, weights=ch, minlength=k) for ch in channels], axis=1) / safe_counts[:, None]
+    cov = np.empty((k, 3, 3))
+    for a in range(3):
+        for b in range(a, 3):
+            second = np.bincount(labels, weights=channels[a] * channels[b], minlength=k) / safe_counts
+            cov[:, a, b] = cov[:, b, a] = second - means[:, a] * means[:, b]
+
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    return {
+        'centers': centers,
+        'counts': counts,
+        'sse': np.maximum(0.0, np.trace(cov, axis1=1, axis2=2) * counts),
+        'spread': np.sqrt(np.maximum(eigvals[:, -1], 0.0))[:, None] * eigvecs[:, :, -1],
+    }
+
+
+def warm_start_centers(summary, n_colors):
+    """Adapt a previous run's centers, given its cluster_summary, to n_colors clusters.
+
+    Adds clusters by splitting the one with the largest squared error along
+    its principal axis, and removes them by merging the closest pair.
+    """
+    clusters = [
+        {'center': center, 'count': count, 'sse': sse, 'spread': spread}
+        for center, count, sse, spread in zip(
+            summary['centers'], summary['counts'], summary['sse'], summary['spread']
+        )
+    ]
+
+    while len(clusters) < n_colors:
+        j = max(range(len(clusters)), key=lambda i: clusters[i]['sse'])
+        parent = clusters.pop(j)
+
+        if parent['spread'] is not None and parent['count'] > 1:
+            offset = 0.8 * parent['spread']
+        else:
+            offset = np.full(3, np.sqrt(parent['sse'] / max(parent['count'], 1) / 3))
+        if not np.any(offset):
+            offset = np.array([1.0, 1.0, 1.0])
+
+        for sign in (1, -1):
+            clusters.append({
+                'center': np.clip(parent['center'] + sign * offset, 0, 255),
+                'count': parent['count'] / 2,
+                'sse': parent['sse'] / 4,
+                'spread': None,
+            })
+
+    while len(clusters) > n_colors:
+        stacked = np.array([c['center'] for c in clusters])
+        dists = ((stacked[:, None, :] - stacked[None, :, :]) ** 2).sum(axis=2)
+        np.fill_diagonal(dists, np.inf)
+        a, b = sorted(np.unravel_index(np.argmin(dists), dists.shape))
+        second = clusters.pop(b)
+        first = clusters.pop(a)
+        count = first['count'] + second['count']
+        weight = first['count'] / count if count else 0.5
+        clusters.append({
+            'center': weight * first['center'] + (1 - weight) * second['center'],
+            'count': count,
+            'sse': first['sse'] + second['sse'] + dists[a, b] * first['count'] * second['count'] / max(count, 1),
+            'spread': None,
+        })
+
+    return np.array([c['center'] for c in clusters])
+
+
+def quantize_image(img_array, n_colors, mode="exact", init=None, trace_memory=True, bits=8):
+    """Cluster image colors, returning (labels, cluster_centers, stats).
+
+    When init centers are given, KMeans runs once from them instead of from
+    several random starts. trace_memory=False skips the tracemalloc peak
+    measurement, whose bookkeeping holds the GIL for seconds on large fits.
+    histogram mode fits on the unique colors (binned to bits per channel)
+    weighted by pixel count, so its cost follows color count, not size.
+    """
+    pixels = img_array.reshape(-1, 3)
+    warm = init is not None
+    if warm:
+        kmeans_init = {'init': np.asarray(init, dtype=np.float64), 'n_init': 1}
+    else:
+        kmeans_init = {'init': 'k-means++', 'n_init': 3 if mode == "fast" else 10}
+
+    unique_colors = None
+    if mode == "fast":
+        sample = stratified_pixel_sample(img_array)
+        kmeans = KMeans(n_clusters=n_colors, random_state=42, max_iter=100, **kmeans_init)
+        _, fit_time, fit_mem = measure_call(kmeans.fit, sample, trace_memory=trace_memory)
+        labels, predict_time, predict_mem = measure_call(
+            predict_labels_chunked, pixels, kmeans.cluster_centers_, trace_memory=trace_memory
+        )
+        centers = kmeans.cluster_centers_
+    elif mode == "histogram":
+        kmeans = KMeans(n_clusters=n_colors, random_state=42, max_iter=300, **kmeans_init)
+        (labels, centers, unique_colors), fit_time, fit_mem = measure_call(
+            fit_color_histogram, kmeans, pixels, n_colors, bits, trace_memory=trace_memory
+        )
+        predict_time, predict_mem = 0.0, (0 if trace_memory else None)
+    else:
+        kmeans = KMeans(n_clusters=n_colors, random_state=42, max_iter=300, **kmeans_init)
+        labels, fit_time, fit_mem = measure_call(kmeans.fit_predict, pixels, trace_memory=trace_memory)
+        predict_time, predict_mem = 0.0, (0 if trace_memory else None)
+        centers = kmeans.cluster_centers_
+
+    stats = {
+        'mode': mode,
+        'init': 'warm' if warm else 'cold',
+        'fit_time': fit_time,
+        'fit_mem': fit_mem,
+        'predict_time': predict_time,
+        'predict_mem': predict_mem,
+        'unique_colors': unique_colors,
+        'bits': bits,
+    }
+    return labels, centers, stats
+
+
+def format_quantize_stats(stats):
+    if stats['init'] == 'reused':
+        return f"{stats['mode']}: reused {stats['num_colors']}-color centers, predict {stats['predict_time']:.2f}s"
+    if stats['init'] == 'restored':
+        return f"{stats['mode']}: restored saved {stats['num_colors']}-color labels"
+    mode = stats['mode']
+    if stats.get('unique_colors') is not None:
+        mode = f"{mode} ({stats['unique_colors']} colors @ {stats['bits']}-bit)"
+    if stats['fit_mem'] is None:
+        return (f"{mode}/{stats['init']}: fit {stats['fit_time']:.2f}s, "
+                f"predict {stats['predict_time']:.2f}s")
+    return (f"{mode}/{stats['init']}: fit {stats['fit_time']:.2f}s/{stats['fit_mem'] / 1e6:.1f}MB, "
+            f"predict {stats['predict_time']:.2f}s/{stats['predict_mem'] / 1e6:.1f}MB")
+
+
+# ==================== Palette Selection ====================
+
+def pack_rgb(pixels):
+    """Pack (N, 3) uint8 RGB rows into 0xRRGGBB integer codes"""
+    pixels = pixels.astype(np.int64)
+    return (pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2]
+
+
+def cluster_medians(pixels, labels, n_colors):
+    """Per-cluster, per-channel median (truncated to int) from value histograms"""
+    medians = np.zeros((n_colors, 3), dtype=np.int64)
+    sizes = np.bincount(labels, minlength=n_colors)
+
+    for channel in range(3):
+        hist = np.bincount(labels * 256 + pixels[:, channel], minlength=n_colors * 256)
+        cum = np.cumsum(hist.reshape(n_colors, 256), axis=1)
+        for i in np.flatnonzero(sizes):
+            n = sizes[i]
+            lo = np.searchsorted(cum[i], (n - 1) // 2, side='right')
+            hi = np.searchsorted(cum[i], n // 2, side='right')
+            medians[i, channel] = (lo + hi) // 2
+
+    return medians
+
+
+def select_palette_colors(pixels, labels, cluster_centers, n_colors, use_exact):
+    """Build (color_palette, original_colors) keyed by 1-based color number.
+
+    With use_exact, each color is the most frequent image color near the
+    cluster centroid, or the cluster median when that is clearly more saturated.
+    """
+    cluster_centers = np.asarray(cluster_centers).astype(int)
+    color_palette = {}
+    original_colors = {}
+
+    for i in range(n_colors):
+        color = tuple(int(c) for c in cluster_centers[i])
+        color_palette[i + 1] = color
+        original_colors[i + 1] = color
+
+    if not use_exact or len(pixels) == 0:
+        return color_palette, original_colors
+
+    n = len(pixels)
+    bits = n.bit_length()
+    index_mask = (1 << bits) - 1
+    labels = labels.astype(np.int64)
+
+    # Sorting (label, color, pixel index) composites groups each cluster's
+    # colors while keeping first-seen order, without a slow stable argsort
+    keys = (labels << 24) | pack_rgb(pixels)
+    composite = np.sort((keys << bits) | np.arange(n))
+    keys = composite >> bits
+    group_starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    first_index = composite[group_starts] & index_mask
+    counts = np.diff(np.append(group_starts, n))
+    key_labels = keys[group_starts] >> 24
+
+    # Within each cluster: most frequent first, ties in first-seen order
+    ranked = np.sort((key_labels << (2 * bits)) | ((n - counts) << bits) | first_index)
+    key_labels = ranked >> (2 * bits)
+    counts = n - ((ranked >> bits) & index_mask)
+    key_colors = pixels[ranked & index_mask].astype(np.int64)
+    starts = np.searchsorted(key_labels, np.arange(n_colors))
+    ends = np.searchsorted(key_labels, np.arange(n_colors), side='right')
+
+    medians = cluster_medians(pixels, labels, n_colors)
+
+    for i in range(n_colors):
+        if starts[i] == ends[i]:
+            continue
+
+        top = slice(starts[i], min(ends[i], starts[i] + 10))
+        top_colors = key_colors[top]
+        top_counts = counts[top]
+
+        dists = np.sqrt(((top_colors - cluster_centers[i]) ** 2).sum(axis=1))
+        eligible = top_counts > top_counts[0] * 0.5
+        best_color = top_colors[np.argmin(np.where(eligible, dists, np.inf))]
+
+        median_color = medians[i]
+        best_sat = best_color.max() - best_color.min()
+        median_sat = median_color.max() - median_color.min()
+
+        final_color = median_color if median_sat > best_sat * 1.2 else best_color
+        color_palette[i + 1] = tuple(int(c) for c in final_color)
+
+    return color_palette, original_colors
+
+
+# ==================== Region Extraction ====================
+
+ORPHAN_GROW_LIMIT = 10  # holes within this many pixels (Chebyshev) of a region join it
+
+
+class RegionStore:
+    """All regions as one int32 id map plus per-region struct-of-arrays stats.
+
+    region_map holds the region id of every pixel (-1 where unassigned).
+    Masks are never stored; mask() builds one on demand, cropped to the
+    region's bounding box.
+    """
+
+    def __init__(self, region_map, color_nums, sizes, bboxes, centroids):
+        self.region_map = region_map
+        self.color_nums = color_nums
+        self.sizes = sizes
+        self.bboxes = bboxes
+        self.centroids = centroids
+
+    @classmethod
+    def from_region_map(cls, region_map, color_nums):
+        """Build a store, computing size, bbox and centroid of every region"""
+        color_nums = np.asarray(color_nums, dtype=np.int32)
+        store = cls(region_map, color_nums, None, None, None)
+        store.recompute_stats()
+        return store
+
+    def recompute_stats(self):
+        count = len(self.color_nums)
+        height, width = self.region_map.shape
+        flat = self.region_map.ravel()
+        valid = flat >= 0
+        ids = flat[valid]
+        positions = np.flatnonzero(valid)
+        ys, xs = np.divmod(positions, width)
+
+        self.sizes = np.bincount(ids, minlength=count).astype(np.int64)
+        safe_sizes = np.maximum(self.sizes, 1)
+        self.centroids = np.stack([
+            np.bincount(ids, weights=ys, minlength=count) / safe_sizes,
+            np.bincount(ids, weights=xs, minlength=count) / safe_sizes,
+        ], axis=1)
+
+        self.bboxes = np.zeros((count, 4), dtype=np.int32)
+        for region_id, sl in enumerate(ndimage.find_objects(self.region_map + 1, max_label=count)):
+            if sl is not None:
+                self.bboxes[region_id] = (sl[0].start, sl[1].start, sl[0].stop, sl[1].stop)
+
+    def resized(self, shape):
+        """Nearest-neighbour resize to shape; stats are mapped from the small map.
+
+        Every output row and column comes from exactly one source row and
+        column, so sizes, centroids and bboxes are weighted sums over the
+        source pixels and never touch the full-size map.
+        """
+        height, width = shape
+        src_h, src_w = self.region_map.shape
+        rows = np.arange(height) * src_h // height
+        cols = np.arange(width) * src_w // width
+
+        row_counts = np.bincount(rows, minlength=src_h).astype(np.float64)
+        col_counts = np.bincount(cols, minlength=src_w).astype(np.float64)
+        row_sums = np.bincount(rows, weights=np.arange(height), minlength=src_h)
+        col_sums = np.bincount(cols, weights=np.arange(width), minlength=src_w)
+
+        count = len(self.color_nums)
+        flat = self.region_map.ravel()
+        valid = flat >= 0
+        ids = flat[valid]
+
+        def weighted(row_weights, col_weights):
+            return np.bincount(ids, weights=np.outer(row_weights, col_weights).ravel()[valid], minlength=count)
+
+        sizes = weighted(row_counts, col_counts)
+        safe_sizes = np.maximum(sizes, 1)
+        centroids = np.stack([
+            weighted(row_sums, col_counts) / safe_sizes,
+            weighted(row_counts, col_sums) / safe_sizes,
+        ], axis=1)
+
+        # First output row/column of each source row/column (plus the end)
+        row_starts = np.searchsorted(rows, np.arange(src_h + 1))
+        col_starts = np.searchsorted(cols, np.arange(src_w + 1))
+        bboxes = np.stack([
+            row_starts[self.bboxes[:, 0]], col_starts[self.bboxes[:, 1]],
+            row_starts[self.bboxes[:, 2]], col_starts[self.bboxes[:, 3]],
+        ], axis=1).astype(np.int32)
+
+        return RegionStore(
+            self.region_map[rows[:, None], cols], self.color_nums, sizes.astype(np.int64), bboxes, centroids
+        )
+
+    def __len__(self):
+        return len(self.color_nums)
+
+    def __iter__(self):
+        return iter(range(len(self.color_nums)))
+
+    @property
+    def shape(self):
+        return self.region_map.shape
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.region_map, self.color_nums, self.sizes, self.bboxes, self.centroids))
+
+    def copy(self):
+        return RegionStore(
+            self.region_map.copy(), self.color_nums.copy(), self.sizes.copy(),
+            self.bboxes.copy(), self.centroids.copy()
+        )
+
+    def color_num(self, region_id):
+        return int(self.color_nums[region_id])
+
+    def size(self, region_id):
+        return int(self.sizes[region_id])
+
+    def bbox_slices(self, region_id):
+        y0, x0, y1, x1 = self.bboxes[region_id]
+        return slice(y0, y1), slice(x0, x1)
+
+    def mask(self, region_id):
+        """Return (bbox slices, bbox-local bool mask) for a region"""
+        slices = self.bbox_slices(region_id)
+        return slices, self.region_map[slices] == region_id
+
+    def region_at(self, x, y):
+        height, width = self.region_map.shape
+        if 0 <= x < width and 0 <= y < height:
+            region_id = int(self.region_map[y, x])
+            if region_id >= 0:
+                return region_id
+        return None
+
+    def to_arrays(self):
+        return {
+            'region_map': self.region_map,
+            'region_color_nums': self.color_nums,
+            'region_sizes': self.sizes,
+            'region_bboxes': self.bboxes,
+            'region_centroids': self.centroids,
+        }
+
+    @classmethod
+    def from_arrays(cls, data):
+        return cls(
+            data['region_map'], data['region_color_nums'], data['region_sizes'],
+            data['region_bboxes'], data['region_centroids']
+        )
+
+
+def create_regions(region_labels, num_colors, min_size):
+    height, width = region_labels.shape
+    region_map = np.full((height, width), -1, dtype=np.int32)
+    claim_map = np.full((height, width), -1, dtype=np.int32)
+    color_nums = []
+    kernel = np.ones((3, 3), np.uint8)
+
+    for color_num in range(num_colors):
+        own = (region_labels == color_num)
+        mask = cv2.morphologyEx(own.astype(np.uint8), cv2.MORPH_CLOSE, kernel, iterations=2)
+
+        num_labels, labeled, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=4)
+
+        # Label 0 is the background; kept components get consecutive region ids
+        kept = stats[:, cv2.CC_STAT_AREA] >= min_size
+        kept[0] = False
+        lut = np.full(num_labels, -1, dtype=np.int32)
+        lut[kept] = np.arange(len(color_nums), len(color_nums) + np.count_nonzero(kept))
+        color_nums.extend([color_num + 1] * int(np.count_nonzero(kept)))
+
+        ids = lut[labeled]
+        owned = own & (ids >= 0)
+        region_map[owned] = ids[owned]
+
+        # Pixels a region only gained through closing go to the first claimant
+        claims = (ids >= 0) & ~own & (claim_map < 0)
+        claim_map[claims] = ids[claims]
+
+    unowned = region_map < 0
+    region_map[unowned] = claim_map[unowned]
+
+    # Pixels still unassigned are left to fill_remaining_holes
+    if color_nums:
+        fill_enclosed_holes(region_map, len(color_nums))
+
+    return RegionStore.from_region_map(region_map, color_nums)
+
+
+def fill_enclosed_holes(region_map, num_regions):
+    """Give each unassigned pocket bordered by a single region to that region"""
+    count, holes = cv2.connectedComponents((region_map < 0).astype(np.uint8), connectivity=4)
+    if count <= 1:
+        return
+
+    # (hole, neighbouring region) pairs across every horizontal and vertical edge
+    pairs = []
+    for hole_side, region_side in (
+        (holes[:, :-1], region_map[:, 1:]), (holes[:, 1:], region_map[:, :-1]),
+        (holes[:-1, :], region_map[1:, :]), (holes[1:, :], region_map[:-1, :]),
+    ):
+        touching = (hole_side > 0) & (region_side >= 0)
+        pairs.append(hole_side[touching].astype(np.int64) * num_regions + region_side[touching])
+    pairs = np.unique(np.concatenate(pairs))
+    hole_ids = pairs // num_regions
+    neighbour_ids = (pairs % num_regions).astype(np.int32)
+
+    enclosed = np.bincount(hole_ids, minlength=count) == 1
+    enclosed[0] = False
+    # Pockets touching the image border are not enclosed
+    enclosed[np.concatenate([holes[0], holes[-1], holes[:, 0], holes[:, -1]])] = False
+
+    lut = np.full(count, -1, dtype=np.int32)
+    single = enclosed[hole_ids]
+    lut[hole_ids[single]] = neighbour_ids[single]
+
+    fill = lut[holes]
+    region_map[fill >= 0] = fill[fill >= 0]
+
+
+def fill_remaining_holes(regions, region_labels, same_color=True):
+    """Return a copy of regions with every unassigned pixel given to a region.
+
+    Pixels within ORPHAN_GROW_LIMIT of a region join the nearest one, so
+    slivers merge into an adjacent region. With same_color, pixels further
+    out go to the nearest region of their own quantized color, or to the
+    nearest region of any color when their color has no regions. Otherwise
+    they also go to the nearest region.
+    """
+    if not regions:
+        return regions
+
+    holes = regions.region_map < 0
+    if not np.any(holes):
+        return regions
+
+    regions = regions.copy()
+    region_map = regions.region_map
+    hole_ys, hole_xs = np.nonzero(holes)
+
+    nearest_y, nearest_x = ndimage.distance_transform_edt(holes, return_distances=False, return_indices=True)
+    nearest_y, nearest_x = nearest_y[hole_ys, hole_xs], nearest_x[hole_ys, hole_xs]
+    fills = region_map[nearest_y, nearest_x]
+
+    hole_colors = region_labels[hole_ys, hole_xs] + 1
+    far = np.maximum(np.abs(nearest_y - hole_ys), np.abs(nearest_x - hole_xs)) > ORPHAN_GROW_LIMIT
+    # Far holes already next to their own color keep the nearest region found above
+    mismatched = far & (regions.color_nums[fills] != hole_colors)
+
+    if same_color and np.any(mismatched):
+        # The nearest pixel of a color always lies on that color's border, so
+        # a KD-tree over border pixels replaces a full distance transform per color
+        pixel_colors = np.where(holes, 0, regions.color_nums[np.maximum(region_map, 0)])
+        border = np.zeros(holes.shape, dtype=bool)
+        for axis in (0, 1):
+            changed = np.diff(pixel_colors, axis=axis) != 0
+            lo = [slice(None), slice(None)]
+            hi = [slice(None), slice(None)]
+            lo[axis], hi[axis] = slice(None, -1), slice(1, None)
+            border[tuple(lo)] |= changed
+            border[tuple(hi)] |= changed
+        border &= ~holes
+
+        border_ys, border_xs = np.nonzero(border)
+        border_colors = pixel_colors[border_ys, border_xs]
+
+        for color_num in np.unique(hole_colors[mismatched]):
+            sources = border_colors == color_num
+            if not np.any(sources):
+                continue
+            selected = mismatched & (hole_colors == color_num)
+            ys, xs = border_ys[sources], border_xs[sources]
+            _, nearest = cKDTree(np.column_stack([ys, xs])).query(
+                np.column_stack([hole_ys[selected], hole_xs[selected]])
+            )
+            fills[selected] = region_map[ys[nearest], xs[nearest]]
+
+    region_map[hole_ys, hole_xs] = fills
+    regions.recompute_stats()
+
+    return regions
+
+
+# ==================== Region Registry ====================
+
+class RegionRegistry:
+    """Color-indexed record of which regions are colored.
+
+    Region ids are grouped by color in one array. Within each color's
+    segment the uncolored ids come first, so coloring or uncoloring a region
+    is a single swap and the per-color counters are always current.
+    """
+
+    def __init__(self, regions=None):
+        self.color_nums = regions.color_nums if regions else np.zeros(0, dtype=np.int32)
+        count = len(self.color_nums)
+
+        self.order = np.argsort(self.color_nums, kind='stable')
+        self.position = np.empty(count, dtype=np.int64)
+        self.position[self.order] = np.arange(count)
+
+        colors, starts, totals = np.unique(self.color_nums[self.order], return_index=True, return_counts=True)
+        self.start = {int(c): int(s) for c, s in zip(colors, starts)}
+        self.total = {int(c): int(t) for c, t in zip(colors, totals)}
+        self.remaining = dict(self.total)
+
+        self.colored = {}
+        self.flags = np.zeros(count, dtype=bool)
+
+    def __len__(self):
+        return len(self.color_nums)
+
+    @property
+    def done_count(self):
+        return len(self.colored)
+
+    def done(self, color_num):
+        return self.total.get(color_num, 0) - self.remaining.get(color_num, 0)
+
+    def _swap(self, i, j):
+        a, b = self.order[i], self.order[j]
+        self.order[i], self.order[j] = b, a
+        self.position[a], self.position[b] = j, i
+
+    def mark_colored(self, region_id):
+        if self.flags[region_id]:
+            return False
+        color_num = int(self.color_nums[region_id])
+        self._swap(self.position[region_id], self.start[color_num] + self.remaining[color_num] - 1)
+        self.remaining[color_num] -= 1
+        self.flags[region_id] = True
+        self.colored[region_id] = color_num
+        return True
+
+    def mark_uncolored(self, region_id):
+        if not self.flags[region_id]:
+            return False
+        color_num = int(self.color_nums[region_id])
+        self._swap(self.position[region_id], self.start[color_num] + self.remaining[color_num])
+        self.remaining[color_num] += 1
+        self.flags[region_id] = False
+        del self.colored[region_id]
+        return True
+
+    def apply(self, colored_regions):
+        """Make colored_regions the colored set; returns the colors that changed"""
+        removed = [r for r in self.colored if r not in colored_regions]
+        added = [r for r in colored_regions if r not in self.colored and 0 <= r < len(self.flags)]
+
+        changed = set()
+        for region_id in removed:
+            self.mark_uncolored(region_id)
+            changed.add(int(self.color_nums[region_id]))
+        for region_id in added:
+            self.mark_colored(region_id)
+            changed.add(int(self.color_nums[region_id]))
+        return changed
+
+    def uncolored(self, color_num=None):
+        """Uncolored region ids of one color, or of all colors grouped by color"""
+        if color_num is not None:
+            start = self.start.get(color_num, 0)
+            return self.order[start:start + self.remaining.get(color_num, 0)]
+        segments = [self.order[self.start[c]:self.start[c] + self.remaining[c]] for c in sorted(self.start)]
+        return np.concatenate(segments) if segments else np.zeros(0, dtype=np.int64)
+
+    def random_uncolored(self):
+        colors = [c for c in self.remaining if self.remaining[c] > 0]
+        if not colors:
+            return None
+        color_num = random.choices(colors, weights=[self.remaining[c] for c in colors])[0]
+        return int(self.order[self.start[color_num] + random.randrange(self.remaining[color_num])])
+
+
+class FillHistory:
+    """Undo log of coloring actions, O(actions) in memory.
+
+    A fill is undone by uncoloring the same region through the region map,
+    so it is logged as just its region id. Clearing is not invertible that
+    way and logs a checkpoint instead: the colored flags packed into a
+    bitset, one bit per region.
+    """
+
+    def __init__(self):
+        self.entries = []  # (kind, payload); entries[:index] are applied
+        self.index = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def record(self, kind, payload):
+        del self.entries[self.index:]
+        self.entries.append((kind, payload))
+        self.index += 1
+
+    def record_fill(self, region_id):
+        self.record('fill', int(region_id))
+
+    def record_clear(self, colored_flags):
+        self.record('clear', (len(colored_flags), np.packbits(colored_flags)))
+
+    @staticmethod
+    def unpack(checkpoint):
+        count, bits = checkpoint
+        return np.unpackbits(bits, count=count).astype(bool)
+
+    def undo(self):
+        """Entry to reverse, or None at the start of the log"""
+        if self.index == 0:
+            return None
+        self.index -= 1
+        return self.entries[self.index]
+
+    def redo(self):
+        """Entry to reapply, or None at the end of the log"""
+        if self.index == len(self.entries):
+            return None
+        self.index += 1
+        return self.entries[self.index - 1]
+
+
+# ==================== Template Rendering ====================
+
+def detect_edges(region_labels):
+    """THIN (1-pixel) region borders."""
+    labels = region_labels.astype(np.int32)
+    h, w = labels.shape
+    edges = np.zeros((h, w), dtype=bool)
+
+    edges[:, :-1] |= (labels[:, :-1] != labels[:, 1:])
+    edges[:-1, :] |= (labels[:-1, :] != labels[1:, :])
+    return edges
+
+
+TEMPLATE_EDGE_COLOR = (60, 60, 60)
+
+
+def render_template(region_labels, regions):
+    height, width = region_labels.shape
+
+    template_image = Image.new('RGB', (width, height), 'white')
+
+    edges = detect_edges(region_labels)
+
+    template_array = np.array(template_image)
+    template_array[edges] = TEMPLATE_EDGE_COLOR
+
+    template_array[(regions.region_map < 0) & ~edges] = [240, 240, 240]
+
+    template_image = Image.fromarray(template_array)
+    draw = ImageDraw.Draw(template_image)
+
+    try:
+        font_size = max(10, min(width, height) // 50)
+        font = ImageFont.truetype("arial.ttf", font_size)
+        small_font = ImageFont.truetype("arial.ttf", max(8, font_size - 2))
+    except Exception:
+        font = ImageFont.load_default()
+        small_font = font
+
+    for region_id in regions:
+        centroid = regions.centroids[region_id]
+        color_num = regions.color_num(region_id)
+        size = regions.size(region_id)
+
+        if size > 500:
+            use_font = font
+        elif size > 200:
+            use_font = small_font
+        else:
+            continue
+
+        y, x = int(centroid[0]), int(centroid[1])
+        text = str(color_num)
+
+        bbox = draw.textbbox((x, y), text, font=use_font)
+        text_width = bbox[2] - bbox[0]
+        text_height = bbox[3] - bbox[1]
+
+        text_x = x - text_width // 2
+        text_y = y - text_height // 2
+
+        if 0 <= y < height and 0 <= x < width:
+            for dx in [-1, 0, 1]:
+                for dy in [-1, 0, 1]:
+                    if dx != 0 or dy != 0:
+                        draw.text((text_x + dx, text_y + dy), text, fill='white', font=use_font)
+            draw.text((text_x, text_y), text, fill='#333333', font=use_font)
+
+    return template_image
+
+
+# ==================== Template Pipeline ====================
+
+PREFILTER_MODES = ("bilateral", "downscale", "guided", "edge_preserving", "tiled", "none")
+PREFILTER_LABELS = {
+    "bilateral": "Bilateral (best)",
+    "downscale": "Half-res bilateral",
+    "guided": "Guided filter",
+    "edge_preserving": "Edge-preserving (recursive)",
+    "tiled": "Tiled bilateral (threads)",
+    "none": "None",
+}
+BILATERAL_DIAMETER = 9
+BILATERAL_SIGMA = 75
+
+
+def guided_filter(guide, src, radius, eps, scale=1):
+    """Per-channel guided filter (He et al.) built from box filters.
+
+    guide and src are float32 HxWxC in [0, 1]. The linear coefficients are
+    fitted at 1/scale resolution and upsampled, which keeps the cost O(1)
+    per pixel and mostly at low resolution. src may already be at that low
+    resolution, making this a joint upsampler that snaps a low-res result
+    back onto the edges of the full-res guide.
+    """
+    height, width = guide.shape[:2]
+    low_size = (max(1, width // scale), max(1, height // scale))
+    guide_low = guide if scale == 1 else cv2.resize(guide, low_size, interpolation=cv2.INTER_AREA)
+    if src is guide:
+        src_low = guide_low
+    elif src.shape[:2] != guide_low.shape[:2]:
+        src_low = cv2.resize(src, low_size, interpolation=cv2.INTER_AREA)
+    else:
+        src_low = src
+
+    ksize = (2 * max(1, radius // scale) + 1,) * 2
+    mean_g = cv2.boxFilter(guide_low, -1, ksize)
+    var_g = cv2.boxFilter(guide_low * guide_low, -1, ksize) - mean_g * mean_g
+    if src_low is guide_low:
+        mean_s, cov = mean_g, var_g
+    else:
+        mean_s = cv2.boxFilter(src_low, -1, ksize)
+        cov = cv2.boxFilter(guide_low * src_low, -1, ksize) - mean_g * mean_s
+    a = cov / (var_g + eps)
+    b = mean_s - a * mean_g
+    a = cv2.boxFilter(a, -1, ksize)
+    b = cv2.boxFilter(b, -1, ksize)
+    if scale != 1:
+        a = cv2.resize(a, (width, height), interpolation=cv2.INTER_LINEAR)
+        b = cv2.resize(b, (width, height), interpolation=cv2.INTER_LINEAR)
+    return a * guide + b
+
+
+def to_float_image(img_array):
+    return img_array.astype(np.float32) / 255
+
+
+def to_uint8_image(img_float):
+    return np.clip(img_float * 255 + 0.5, 0, 255).astype(np.uint8)
+
+
+def tiled_bilateral(img_array, tiles=None):
+    """Bilateral filter over horizontal strips on a thread pool.
+
+    Each strip carries a filter-radius overlap, so the stitched output is
+    identical to a single full-image call; cv2 releases the GIL, so strips
+    run in parallel.
+    """
+    height = img_array.shape[0]
+    tiles = max(1, min(tiles or os.cpu_count() or 1, height // 64 or 1))
+    pad = BILATERAL_DIAMETER // 2
+    bounds = np.linspace(0, height, tiles + 1).astype(int)
+    out = np.empty_like(img_array)
+
+    def filter_strip(i):
+        y0, y1 = bounds[i], bounds[i + 1]
+        top, bottom = max(0, y0 - pad), min(height, y1 + pad)
+        strip = cv2.bilateralFilter(img_array[top:bottom], BILATERAL_DIAMETER, BILATERAL_SIGMA, BILATERAL_SIGMA)
+        out[y0:y1] = strip[y0 - top:y1 - top]
+
+    with ThreadPoolExecutor(max_workers=tiles) as pool:
+        list(pool.map(filter_strip, range(tiles)))
+    return out
+
+
+def prefilter_image(img_array, mode="bilateral"):
+    """Edge-preserving smoothing before quantization; see PREFILTER_MODES.
+
+    bilateral is the reference. downscale filters at half resolution and
+    restores edges with a guided joint upsample; guided and edge_preserving
+    are linear-time approximations; tiled is exact bilateral spread across
+    threads; none skips smoothing.
+    """
+    if mode == "none":
+        return img_array
+    if mode == "tiled":
+        return tiled_bilateral(img_array)
+    if mode == "edge_preserving":
+        return cv2.edgePreservingFilter(img_array, flags=cv2.RECURS_FILTER, sigma_s=10, sigma_r=0.3)
+    if mode == "guided":
+        img_float = to_float_image(img_array)
+        return to_uint8_image(guided_filter(img_float, img_float, 2, 0.01, scale=2))
+    if mode == "downscale":
+        height, width = img_array.shape[:2]
+        small = cv2.resize(img_array, (max(1, width // 2), max(1, height // 2)), interpolation=cv2.INTER_AREA)
+        small = cv2.bilateralFilter(small, BILATERAL_DIAMETER // 2 + 1, BILATERAL_SIGMA, BILATERAL_SIGMA)
+        return to_uint8_image(guided_filter(to_float_image(img_array), to_float_image(small), 1, 0.001, scale=2))
+    return cv2.bilateralFilter(img_array, BILATERAL_DIAMETER, BILATERAL_SIGMA, BILATERAL_SIGMA)
+
+
+class TemplatePipeline:
+    """Staged template generation with memoized stage outputs.
+
+    A stage's signature covers its own parameters plus the signatures of the
+    stages it reads from, so changing a parameter only reruns the stages
+    downstream of it.
+    """
+
+    # (stage, upstream stages, generation params read by the stage)
+    STAGES = (
+        ('filter', (), ('prefilter',)),
+        ('quantize', ('filter',), ('num_colors', 'quantize_mode', 'histogram_bits')),
+        ('palette', ('filter', 'quantize'), ('use_exact_colors',)),
+        ('regions', ('quantize',), ('min_region_size',)),
+        ('holes', ('quantize', 'regions'), ('fill_micro_holes',)),
+        ('render', ('quantize', 'holes'), ()),
+    )
+    # Generation params that change how a template is reached, not what it is for
+    OPTIONS = ('incremental_quantize', 'progressive_preview')
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.quantize_init = None
+        self.quantize_labels = None
+        self.memo = {}
+        self.signatures = {}
+        # (filter signature, mode, bits, num_colors) -> cluster_summary, for warm
+        # starts; only kept for the image of the latest run
+        self.quantize_history = OrderedDict()
+
+    def stage_signatures(self, img_array, params, seeded=False):
+        """Per-stage signatures; seeded marks a quantize started from quantize_init centers"""
+        image_key = hashlib.sha256(np.ascontiguousarray(img_array).tobytes()).hexdigest()
+        signatures = {'image': image_key}
+        for name, deps, keys in self.STAGES:
+            signature = (
+                image_key,
+                tuple(params[k] for k in keys),
+                tuple(signatures[d] for d in deps),
+            )
+            if seeded and name == 'quantize':
+                signature += ('init',)
+            signatures[name] = hashlib.sha256(repr(signature).encode()).hexdigest()
+        return signatures
+
+    def is_memoized(self, stage, img_array, params, seeded=False):
+        memo = self.memo.get(stage)
+        return memo is not None and memo[0] == self.stage_signatures(img_array, params, seeded)[stage]
+
+    def run(self, img_array, params, progress=None, quantize_init=None, quantize_labels=None):
+        """Run all stages, reusing memoized outputs whose signature is unchanged.
+
+        progress(stage, index, total) is called before each stage; raising
+        from it abandons the run between stages. quantize_init centers seed
+        an incremental quantize that has no exact earlier result to reuse.
+        quantize_labels, a label map saved with progress, stands in for the
+        quantize result so restored region ids match the saved ones.
+        """
+        seeded = quantize_init is not None
+        if not seeded and quantize_labels is None and self.is_memoized('quantize', img_array, params, seeded=True):
+            seeded = True  # a seeded quantize is as good as a fresh one; keep it and what was built on it
+        signatures = self.stage_signatures(img_array, params, seeded)
+        if signatures['image'] != self.signatures.get('image'):
+            self.quantize_history = OrderedDict()
+        if quantize_labels is not None:
+            # Everything downstream of quantize has to follow the saved labels
+            self.memo = {name: memo for name, memo in self.memo.items() if name == 'filter'}
+        self.signatures = signatures
+        self.quantize_init = quantize_init
+        self.quantize_labels = quantize_labels
+        outputs = {}
+        ran = []
+        times = {}
+
+        for index, (name, deps, keys) in enumerate(self.STAGES):
+            if progress is not None:
+                progress(name, index, len(self.STAGES))
+
+            signature = signatures[name]
+            memo = self.memo.get(name)
+            if memo is not None and memo[0] == signature:
+                outputs[name] = memo[1]
+                continue
+
+            start = time.perf_counter()
+            outputs[name] = getattr(self, f"_stage_{name}")(img_array, params, outputs)
+            times[name] = time.perf_counter() - start
+            ran.append(name)
+            self.memo[name] = (signature, outputs[name])
+
+        quantized = outputs['quantize']
+        color_palette, original_colors = outputs['palette']
+        return {
+            'region_labels': quantized['labels'],
+            'centers': quantized['centers'],
+            'quantize_stats': quantized['stats'],
+            'color_palette': color_palette,
+            'original_colors': original_colors,
+            'regions': outputs['holes'],
+            'template_image': outputs['render'],
+            'seeded': seeded,
+            'ran': ran,
+            'times': times,
+        }
+
+    def _stage_filter(self, img_array, params, outputs):
+        return prefilter_image(img_array, params['prefilter'])
+
+    def _stage_quantize(self, img_array, params, outputs):
+        filtered = outputs['filter']
+        mode = params['quantize_mode']
+        n_colors = params['num_colors']
+        bits = params['histogram_bits'] if mode == "histogram" else 8
+
+        if self.quantize_labels is not None:
+            return self._restore_quantize(filtered, n_colors, mode)
+        if not params['incremental_quantize']:
+            return self._quantize(filtered, n_colors, mode, bits=bits)
+
+        history_key = (self.signatures['filter'], mode, bits)
+        pixels = filtered.reshape(-1, 3)
+        previous = self.quantize_history.get(history_key + (n_colors,))
+        if previous is not None:
+            self.quantize_history.move_to_end(history_key + (n_colors,))
+            start = time.perf_counter()
+            labels = predict_labels_chunked(pixels, previous['centers'])
+            stats = {'mode': mode, 'init': 'reused', 'num_colors': n_colors,
+                     'predict_time': time.perf_counter() - start}
+            return {'labels': labels.reshape(filtered.shape[:2]), 'centers': previous['centers'], 'stats': stats}
+
+        nearby = [key[-1] for key in self.quantize_history if key[:-1] == history_key]
+        init = self.quantize_init
+        if init is None and nearby:
+            nearest = self.quantize_history[history_key + (min(nearby, key=lambda k: abs(k - n_colors)),)]
+            init = warm_start_centers(nearest, n_colors)
+
+        quantized = self._quantize(filtered, n_colors, mode, init, bits)
+        self.quantize_history[history_key + (n_colors,)] = cluster_summary(
+            pixels, quantized['labels'], quantized['centers']
+        )
+        while len(self.quantize_history) > QUANTIZE_HISTORY_SIZE:
+            self.quantize_history.popitem(last=False)
+        return quantized
+
+    def _restore_quantize(self, filtered, n_colors, mode):
+        """Saved labels with the mean filtered color of each as its center"""
+        flat = self.quantize_labels.ravel()
+        pixels = filtered.reshape(-1, 3)
+        counts = np.maximum(np.bincount(flat, minlength=n_colors), 1)
+        centers = np.stack([
+            np.bincount(flat, weights=pixels[:, c], minlength=n_colors) for c in range(3)
+        ], axis=1) / counts[:, None]
+        stats = {'mode': mode, 'init': 'restored', 'num_colors': n_colors}
+        return {'labels': self.quantize_labels, 'centers': centers, 'stats': stats}
+
+    def _quantize(self, filtered, n_colors, mode, init=None, bits=8):
+        labels, centers, stats = quantize_image(filtered, n_colors, mode, init, self.trace_memory, bits)
+        return {
+            'labels': labels.reshape(filtered.shape[:2]),
+            'centers': centers,
+            'stats': stats,
+        }
+
+    def _stage_palette(self, img_array, params, outputs):
+        quantized = outputs['quantize']
+        return select_palette_colors(
+            outputs['filter'].reshape(-1, 3), quantized['labels'].ravel(), quantized['centers'],
+            params['num_colors'], params['use_exact_colors']
+        )
+
+    def _stage_regions(self, img_array, params, outputs):
+        return create_regions(outputs['quantize']['labels'], params['num_colors'], params['min_region_size'])
+
+    def _stage_holes(self, img_array, params, outputs):
+        return fill_remaining_holes(
+            outputs['regions'], outputs['quantize']['labels'], same_color=params['fill_micro_holes']
+        )
+
+    def _stage_render(self, img_array, params, outputs):
+        return render_template(outputs['quantize']['labels'], outputs['holes'])
+
+
+def format_pipeline_stats(result):
+    if result.get('cached'):
+        return "cached"
+    if not result['ran']:
+        return "all stages reused"
+    parts = [f"{name} {result['times'][name]:.2f}s" for name in result['ran']]
+    if 'quantize' in result['ran']:
+        parts.append(format_quantize_stats(result['quantize_stats']))
+    return ", ".join(parts)
+
+
+# ==================== Template Cache ====================
+
+TEMPLATE_CACHE_VERSION = 2
+TEMPLATE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+def default_cache_dir():
+    base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'ColorByNumber', 'templates')
+
+
+class TemplateCache:
+    """Size-bounded LRU store of generated templates, zstd-compressed on disk"""
+
+    def __init__(self, cache_dir=None, max_bytes=TEMPLATE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+
+    @property
+    def enabled(self):
+        return zstandard is not None
+
+    @staticmethod
+    def make_key(img_array, params, quantize_labels=None, seeded=False):
+        """Key for a template; one restored from saved labels is keyed by them too.
+
+        seeded marks a template whose quantize started from preview centers.
+        """
+        params = {k: v for k, v in params.items() if k not in TemplatePipeline.OPTIONS}
+        digest = hashlib.sha256()
+        digest.update(f"v{TEMPLATE_CACHE_VERSION}".encode())
+        digest.update(repr(img_array.shape).encode())
+        digest.update(np.ascontiguousarray(img_array).tobytes())
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        if seeded:
+            digest.update(b"init")
+        if quantize_labels is not None:
+            digest.update(b"labels")
+            digest.update(repr(quantize_labels.shape).encode())
+            digest.update(np.ascontiguousarray(quantize_labels).tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz.zst")
+
+    def load(self, key):
+        """Return the stored arrays for key, or None on a miss"""
+        if not self.enabled:
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                raw = zstandard.ZstdDecompressor().decompress(f.read())
+            with np.load(io.BytesIO(raw), allow_pickle=False) as npz:
+                data = {name: npz[name] for name in npz.files}
+            os.utime(path)  # mark as recently used
+            return data
+        except Exception:
+            return None
+
+    def store(self, key, arrays):
+        if not self.enabled:
+            return
+
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        compressed = zstandard.ZstdCompressor(level=3).compress(buffer.getvalue())
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits max_bytes"""
+        try:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.npz.zst'):
+                    st = os.stat(os.path.join(self.cache_dir, name))
+                    entries.append((st.st_mtime, st.st_size, name))
+        except OSError:
+            return
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                total -= size
+            except OSError:
+                pass
+
+
+def template_to_arrays(result):
+    """Flatten a pipeline result into the arrays stored in the cache"""
+    palette, original_colors = result['color_palette'], result['original_colors']
+    palette_nums = sorted(palette)
+    arrays = {
+        'region_labels': result['region_labels'].astype(np.int32),
+        'palette_nums': np.array(palette_nums, dtype=np.int32),
+        'palette': np.array([palette[n] for n in palette_nums], dtype=np.int32),
+        'original_colors': np.array([original_colors[n] for n in palette_nums], dtype=np.int32),
+        'template': np.array(result['template_image']),
+    }
+    arrays.update(result['regions'].to_arrays())
+    return arrays
+
+
+def template_from_arrays(data):
+    """Rebuild a pipeline-shaped result from cached arrays"""
+    nums = [int(n) for n in data['palette_nums']]
+    return {
+        'region_labels': data['region_labels'],
+        'quantize_stats': None,
+        'color_palette': {n: tuple(int(c) for c in color) for n, color in zip(nums, data['palette'])},
+        'original_colors': {n: tuple(int(c) for c in color) for n, color in zip(nums, data['original_colors'])},
+        'regions': RegionStore.from_arrays(data),
+        'template_image': Image.fromarray(data['template']),
+        'ran': [],
+        'times': {},
+        'cached': True,
+    }
+
+
+# ==================== Background Generation ====================
+
+GENERATION_POLL_MS = 30
+SHARED_ARRAY_ALIGN = 64
+PREVIEW_SCALE = 4
+PREVIEW_MIN_PIXELS = 250000
+
+
+def upscale_template(result, shape):
+    """Blow a coarse pipeline result up to shape with nearest-neighbour sampling"""
+    height, width = shape
+    src_h, src_w = result['region_labels'].shape
+    rows = (np.arange(height) * src_h // height)[:, None]
+    cols = np.arange(width) * src_w // width
+
+    template = np.array(result['template_image'])[rows, cols]
+    return dict(
+        result,
+        region_labels=result['region_labels'][rows, cols],
+        regions=result['regions'].resized(shape),
+        template_image=Image.fromarray(template),
+    )
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+class SharedArrays:
+    """Named arrays packed into one shared-memory block.
+
+    Only the manifest (block name plus dtype, shape and offset per array)
+    needs pickling; the other side attaches and views the same pages.
+    """
+
+    def __init__(self, shm, manifest):
+        self.shm = shm
+        self.manifest = manifest
+        self.arrays = {
+            name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            for name, dtype, shape, offset in manifest['arrays']
+        }
+
+    @classmethod
+    def create(cls, arrays):
+        layout = []
+        size = 0
+        for name, array in arrays.items():
+            layout.append((name, array.dtype.str, array.shape, size))
+            size += -(-array.nbytes // SHARED_ARRAY_ALIGN) * SHARED_ARRAY_ALIGN
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        block = cls(shm, {'name': shm.name, 'arrays': layout})
+        for name, array in arrays.items():
+            block.arrays[name][...] = array
+        return block
+
+    @classmethod
+    def attach(cls, manifest):
+        return cls(shared_memory.SharedMemory(name=manifest['name']), manifest)
+
+    def close(self):
+        """Unmap the block; returns False while arrays viewing it are still alive"""
+        self.arrays = {}
+        try:
+            self.shm.close()
+        except BufferError:
+            return False
+        return True
+
+
+def template_worker_main(conn, abort, cache_dir, cache_max_bytes):
+    """Entry point of the template worker process"""
+    generator = TemplateGenerator(TemplatePipeline(trace_memory=False), TemplateCache(cache_dir, cache_max_bytes))
+    result_blocks = []
+
+    def progress(stage, index, total):
+        if abort.is_set():
+            raise GenerationCancelled()
+        conn.send(('progress', (stage, index, total)))
+
+    def send_result(kind, result):
+        block = SharedArrays.create(template_to_arrays(result))
+        result_blocks.append(block)
+        meta = {key: result.get(key) for key in ('quantize_stats', 'ran', 'times', 'cached', 'preview_time')}
+        conn.send((kind, (block.manifest, meta)))
+
+    while True:
+        try:
+            manifest, params = conn.recv()
+        except EOFError:
+            break
+
+        # The app attached the previous results before sending a new request
+        for block in result_blocks:
+            block.close()
+        result_blocks.clear()
+
+        image_block = SharedArrays.attach(manifest)
+        img_array = image_block.arrays['image'].copy()
+        quantize_labels = image_block.arrays.get('quantize_labels')
+        if quantize_labels is not None:
+            quantize_labels = quantize_labels.copy()
+        image_block.close()
+
+        try:
+            result = generator.build(
+                img_array, params, progress, lambda coarse: send_result('preview', coarse), quantize_labels
+            )
+            send_result('done', result)
+        except GenerationCancelled:
+            conn.send(('cancelled', None))
+        except Exception as e:
+            conn.send(('error', f"{type(e).__name__}: {e}"))
+
+
+class TemplateWorkerProcess:
+    """Persistent process that builds templates out of the app's process.
+
+    Its imports and pipeline memo stay warm across requests, a crash in
+    native code only costs the worker (restarted on the next request), and
+    pixels travel both ways as SharedArrays blocks rather than pickles.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+        self.conn = None
+        self.abort = None
+        self.segments = []  # result blocks whose arrays may still be in use
+
+    def start(self):
+        if self.process is not None and self.process.is_alive():
+            return
+        self.conn, child_conn = self.context.Pipe()
+        self.abort = self.context.Event()
+        self.process = self.context.Process(
+            target=template_worker_main,
+            args=(child_conn, self.abort, self.cache.cache_dir, self.cache.max_bytes),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def release_segments(self):
+        self.segments = [block for block in self.segments if not block.close()]
+
+    def build(self, img_array, params, progress, preview, cancel_event, quantize_labels=None):
+        self.start()
+        self.release_segments()
+        self.abort.clear()
+
+        arrays = {'image': np.ascontiguousarray(img_array)}
+        if quantize_labels is not None:
+            arrays['quantize_labels'] = quantize_labels
+        image_block = SharedArrays.create(arrays)
+        try:
+            self.conn.send((image_block.manifest, params))
+            kind, payload = self._wait(progress, preview, cancel_event)
+        except (EOFError, OSError):
+            self.process = None
+            raise RuntimeError("template worker process exited unexpectedly")
+        finally:
+            image_block.close()
+            image_block.shm.unlink()
+
+        if kind == 'cancelled':
+            raise GenerationCancelled()
+        if kind == 'error':
+            raise RuntimeError(payload)
+
+        return self._attach_result(payload)
+
+    def _attach_result(self, payload):
+        manifest, meta = payload
+        block = SharedArrays.attach(manifest)
+        block.shm.unlink()  # the mapping outlives the name
+        self.segments.append(block)
+
+        result = template_from_arrays(block.arrays)
+        result.update(meta)
+        return result
+
+    def _wait(self, progress, preview, cancel_event):
+        """Relay progress and previews until the worker answers; cancellation goes through abort"""
+        while True:
+            if cancel_event.is_set():
+                self.abort.set()
+            if not self.conn.poll(0.05):
+                if not self.process.is_alive():
+                    raise EOFError()
+                continue
+
+            kind, payload = self.conn.recv()
+            if kind == 'preview':
+                preview(self._attach_result(payload))
+                continue
+            if kind != 'progress':
+                return kind, payload
+            try:
+                progress(*payload)
+            except GenerationCancelled:
+                self.abort.set()
+
+
+class TemplateGenerator:
+    """Builds templates on a worker thread, one request at a time.
+
+    Submitting a request supersedes the previous one, which stops at its next
+    stage boundary. Progress and results are queued by the worker and picked
+    up on the Tk thread through poll(), so no Tk call happens off-thread.
+    With the "process" engine the thread only relays to a TemplateWorkerProcess.
+    """
+
+    def __init__(self, pipeline, cache):
+        self.pipeline = pipeline
+        self.preview_pipeline = TemplatePipeline(trace_memory=False)
+        self.cache = cache
+        self.worker_process = None
+        self.events = queue.Queue()
+        self.lock = threading.Lock()  # one job at a time touches the pipeline memo
+        self.job_id = 0
+        self.finished_id = 0
+        self.cancel_event = threading.Event()
+
+    @property
+    def busy(self):
+        return self.finished_id != self.job_id
+
+    def submit(self, img_array, params, engine="thread", quantize_labels=None):
+        self.cancel()
+        self.job_id += 1
+        self.cancel_event = threading.Event()
+        threading.Thread(
+            target=self._run, args=(self.job_id, img_array, params, engine, self.cancel_event, quantize_labels),
+            daemon=True
+        ).start()
+        return self.job_id
+
+    def cancel(self):
+        """Abandon the current job; returns whether one was running"""
+        was_busy = self.busy
+        self.cancel_event.set()
+        self.finished_id = self.job_id
+        return was_busy
+
+    def is_current(self, job_id):
+        """Whether job_id is the latest job and has not been cancelled"""
+        return job_id == self.job_id and not self.cancel_event.is_set()
+
+    def poll(self):
+        """(job_id, kind, payload) events of the current job: 'progress', 'preview', 'done' or 'error'"""
+        events = []
+        while True:
+            try:
+                job_id, kind, payload = self.events.get_nowait()
+            except queue.Empty:
+                return events
+            if job_id != self.job_id or not self.busy:
+                continue  # superseded or cancelled
+            if kind in ('done', 'error'):
+                self.finished_id = job_id
+            events.append((job_id, kind, payload))
+
+    def _run(self, job_id, img_array, params, engine, cancel_event, quantize_labels):
+        def progress(stage, index, total):
+            if cancel_event.is_set():
+                raise GenerationCancelled()
+            self.events.put((job_id, 'progress', (stage, index, total)))
+
+        def preview(result):
+            self.events.put((job_id, 'preview', result))
+
+        try:
+            with self.lock:
+                if engine == "process":
+                    if self.worker_process is None:
+                        self.worker_process = TemplateWorkerProcess(self.cache)
+                    result = self.worker_process.build(
+                        img_array, params, progress, preview, cancel_event, quantize_labels
+                    )
+                else:
+                    result = self.build(img_array, params, progress, preview, quantize_labels)
+            self.events.put((job_id, 'done', result))
+        except GenerationCancelled:
+            pass
+        except Exception as e:
+            self.events.put((job_id, 'error', e))
+
+    def build(self, img_array, params, progress=None, preview=None, quantize_labels=None):
+        """Template for img_array; preview(result) gets a coarse one first when worthwhile.
+
+        With quantize_labels (restoring saved progress) the template is cached
+        under a key that includes the labels, and no preview is shown since it
+        could disagree with them.
+        """
+        data = self.cache.load(TemplateCache.make_key(img_array, params, quantize_labels))
+        if data is None and quantize_labels is None and params['incremental_quantize'] and params['progressive_preview']:
+            # A template refined from preview centers is keyed apart from a cold one
+            data = self.cache.load(TemplateCache.make_key(img_array, params, seeded=True))
+        if data is not None:
+            return template_from_arrays(data)
+
+        init = None
+        if quantize_labels is None and preview is not None and self.wants_preview(img_array, params):
+            if progress is not None:
+                progress('preview', 0, 1)
+            coarse = self.build_preview(img_array, params)
+            preview(coarse)
+            if params['incremental_quantize']:
+                init = coarse['centers']
+
+        result = self.pipeline.run(img_array, params, progress, quantize_init=init, quantize_labels=quantize_labels)
+        try:
+            cache_key = TemplateCache.make_key(img_array, params, quantize_labels, result['seeded'])
+            self.cache.store(cache_key, template_to_arrays(result))
+        except Exception:
+            pass  # caching is best-effort
+        return result
+
+    def wants_preview(self, img_array, params):
+        # Only worth it when the slow full-size quantize actually has to run
+        return (params.get('progressive_preview') and img_array.shape[0] * img_array.shape[1] >= PREVIEW_MIN_PIXELS
+                and not self.pipeline.is_memoized('quantize', img_array, params)
+                and not self.pipeline.is_memoized('quantize', img_array, params, seeded=True))
+
+    def build_preview(self, img_array, params):
+        """Run the pipeline on a 1/PREVIEW_SCALE copy and upscale the result"""
+        height, width = img_array.shape[:2]
+        small = cv2.resize(
+            img_array, (max(1, width // PREVIEW_SCALE), max(1, height // PREVIEW_SCALE)),
+            interpolation=cv2.INTER_AREA
+        )
+        small_params = dict(params, min_region_size=max(1, params['min_region_size'] // PREVIEW_SCALE ** 2))
+
+        start = time.perf_counter()
+        result = upscale_template(self.preview_pipeline.run(small, small_params), (height, width))
+        result['preview_time'] = time.perf_counter() - start
+        return result
+
+
+# ==================== Display Surface ====================
+
+FRAMEBUFFER_MAX_DIRTY_RECTS = 64
+
+
+class FrameBuffer:
+    """Persistent uint8 RGB display surface, painted in place.
+
+    Every change is recorded as a dirty rect (y0, x0, y1, x1) so the canvas
+    can refresh only what changed; a PIL view is built lazily and reused
+    until the next change.
+    """
+
+    def __init__(self):
+        self.array = None
+        self.dirty = []
+        self._image = None
+
+    def __bool__(self):
+        return self.array is not None
+
+    @property
+    def size(self):
+        return self.array.shape[1], self.array.shape[0]
+
+    def load(self, source):
+        """Replace the whole surface with a copy of a PIL image or RGB array"""
+        image = source.convert('RGB') if isinstance(source, Image.Image) else None
+        self.array = np.array(source if image is None else image, dtype=np.uint8)
+        self.dirty = []
+        self.mark_dirty(0, 0, *self.array.shape[:2])
+        self._image = image  # same pixels as the array, so it doubles as the view
+
+    def mark_dirty(self, y0, x0, y1, x1):
+        self._image = None
+        self.dirty.append((y0, x0, y1, x1))
+        if len(self.dirty) > FRAMEBUFFER_MAX_DIRTY_RECTS:
+            rects = np.array(self.dirty)
+            self.dirty = [(rects[:, 0].min(), rects[:, 1].min(), rects[:, 2].max(), rects[:, 3].max())]
+
+    def take_dirty(self):
+        dirty, self.dirty = self.dirty, []
+        return dirty
+
+    def paint(self, slices, mask, color):
+        """Write color (one RGB value or one per mask pixel) under a bbox mask"""
+        self.array[slices][mask] = color
+        self.mark_dirty(slices[0].start, slices[1].start, slices[0].stop, slices[1].stop)
+
+    def read(self, slices, mask):
+        return self.array[slices][mask].copy()
+
+    def image(self):
+        """PIL view of the current pixels; treat as read-only"""
+        if self._image is None:
+            self._image = Image.fromarray(self.array)
+        return self._image
+
+
+class ViewCompositor:
+    """Builds the template and progress views with lookup-table gathers.
+
+    Each region maps to its palette color while colored, so a view is one
+    gather over the region map instead of a mask write per region. Views are
+    cached until the palette or the colored flags change.
+    """
+
+    def __init__(self, template, region_labels, regions, color_palette):
+        self.template = np.asarray(template, dtype=np.uint8)
+        self.region_labels = region_labels
+        self.region_map = regions.region_map
+        self.color_nums = regions.color_nums
+        self.views = {}
+        self.set_palette(color_palette)
+
+    def set_palette(self, color_palette):
+        """256-entry cv2 LUT indexed by color number; unused entries stay black"""
+        self.palette_lut = np.zeros((256, 1, 3), dtype=np.uint8)
+        for color_num, color in color_palette.items():
+            self.palette_lut[color_num, 0] = color
+        self.views = {}
+
+    def lookup(self, color_index):
+        """RGB image for a uint8 image of color numbers"""
+        return cv2.LUT(cv2.merge([color_index] * 3), self.palette_lut)
+
+    def progress_view(self):
+        if 'progress' not in self.views:
+            self.views['progress'] = self.lookup((self.region_labels + 1).astype(np.uint8))
+        return self.views['progress']
+
+    def template_view(self, colored_flags):
+        cached = self.views.get('template')
+        if cached is not None and np.array_equal(cached[0], colored_flags):
+            return cached[1]
+
+        # Color number per region while colored, 0 (template) otherwise; the
+        # trailing 0 is what region_map's -1 (no region) indexes
+        region_lut = np.append(np.where(colored_flags, self.color_nums, 0), 0).astype(np.uint8)
+        color_index = region_lut[self.region_map]
+        view = cv2.copyTo(self.template, (color_index == 0).view(np.uint8), self.lookup(color_index))
+
+        self.views['template'] = (colored_flags.copy(), view)
+        return view
+
+
+# Fixed zoom ladder (sixth-octave steps, 0.22x..4.49x) so zoomed tiles can be reused
+ZOOM_LEVELS = tuple(2 ** (k / 6) for k in range(-13, 14))
+TILE_SIZE = 256
+TILE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+def nearest_zoom_index(zoom):
+    return min(range(len(ZOOM_LEVELS)), key=lambda i: abs(np.log(ZOOM_LEVELS[i] / zoom)))
+
+
+class TileRenderer:
+    """Draws a framebuffer onto a canvas as a grid of zoomed screen tiles.
+
+    Only tiles inside the canvas are scaled (crop first, then nearest-neighbour
+    gather), scaled tiles are cached per zoom level, and a tile touched by a
+    dirty rect is re-pasted into its existing PhotoImage in place.
+    """
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.items = {}  # (tx, ty) -> (canvas item id, PhotoImage)
+        self.cache = OrderedDict()  # (zoom, tx, ty) -> scaled tile array
+        self.cache_bytes = 0
+        self.zoom = None
+        self.image_size = None
+        self.tile_range = None
+
+    def clear(self):
+        self.canvas.delete("tile")
+        self.items = {}
+
+    def zoomed_size(self, zoom):
+        return int(self.image_size[0] * zoom), int(self.image_size[1] * zoom)
+
+    def visible_range(self, zoom, offset):
+        """(tx0, ty0, tx1, ty1) of the tiles overlapping the canvas"""
+        zoomed_w, zoomed_h = self.zoomed_size(zoom)
+        canvas_w, canvas_h = self.canvas.winfo_width(), self.canvas.winfo_height()
+        tx0 = max(0, -offset[0] // TILE_SIZE)
+        ty0 = max(0, -offset[1] // TILE_SIZE)
+        tx1 = min(-(-zoomed_w // TILE_SIZE), -(-(canvas_w - offset[0]) // TILE_SIZE))
+        ty1 = min(-(-zoomed_h // TILE_SIZE), -(-(canvas_h - offset[1]) // TILE_SIZE))
+        return tx0, ty0, tx1, ty1
+
+    def render(self, framebuffer, zoom, offset):
+        if framebuffer.size != self.image_size:
+            self.image_size = framebuffer.size
+            self.drop_cache(lambda key: True)
+            self.clear()
+        if zoom != self.zoom:
+            self.zoom = zoom
+            self.clear()
+
+        stale = self.invalidate(framebuffer.take_dirty())
+        self.tile_range = tx0, ty0, tx1, ty1 = self.visible_range(zoom, offset)
+        visible = [(tx, ty) for ty in range(ty0, ty1) for tx in range(tx0, tx1)]
+
+        for key in set(self.items) - set(visible):
+            self.canvas.delete(self.items.pop(key)[0])
+
+        for key in visible:
+            x = offset[0] + key[0] * TILE_SIZE
+            y = offset[1] + key[1] * TILE_SIZE
+            if key not in self.items:
+                photo = ImageTk.PhotoImage(Image.fromarray(self.tile(framebuffer.array, key)))
+                item = self.canvas.create_image(x, y, anchor=tk.NW, image=photo, tags="tile")
+                self.items[key] = (item, photo)
+            else:
+                item, photo = self.items[key]
+                self.canvas.coords(item, x, y)
+                if key in stale:
+                    photo.paste(Image.fromarray(self.tile(framebuffer.array, key)))
+
+    def pan(self, framebuffer, offset, dx, dy):
+        """Shift the drawn tiles; tiles are only rendered when new ones come into view"""
+        self.canvas.move("tile", dx, dy)
+        if framebuffer.dirty or self.visible_range(self.zoom, offset) != self.tile_range:
+            self.render(framebuffer, self.zoom, offset)
+
+    def invalidate(self, dirty):
+        """Drop cached tiles under the dirty rects; returns the stale tile keys"""
+        if not dirty:
+            return set()
+
+        zoom = self.zoom
+        rects = [(int(y0 * zoom), int(x0 * zoom), int(np.ceil(y1 * zoom)), int(np.ceil(x1 * zoom)))
+                 for y0, x0, y1, x1 in dirty]
+
+        def hit(tx, ty):
+            left, top = tx * TILE_SIZE, ty * TILE_SIZE
+            return any(y0 < top + TILE_SIZE and y1 > top and x0 < left + TILE_SIZE and x1 > left
+                       for y0, x0, y1, x1 in rects)
+
+        # Other zoom levels are dropped whole rather than intersected
+        self.drop_cache(lambda key: key[0] != zoom or hit(key[1], key[2]))
+        return {key for key in self.items if hit(*key)}
+
+    def drop_cache(self, predicate):
+        for key in [key for key in self.cache if predicate(key)]:
+            self.cache_bytes -= self.cache.pop(key).nbytes
+
+    def tile(self, array, key):
+        cache_key = (self.zoom,) + key
+        tile = self.cache.get(cache_key)
+        if tile is not None:
+            self.cache.move_to_end(cache_key)
+            return tile
+
+        zoomed_w, zoomed_h = self.zoomed_size(self.zoom)
+        height, width = array.shape[:2]
+        tx, ty = key
+        # Screen pixel d shows image pixel floor(d / zoom), matching the click mapping
+        xs = np.arange(tx * TILE_SIZE, min((tx + 1) * TILE_SIZE, zoomed_w)) / self.zoom
+        ys = np.arange(ty * TILE_SIZE, min((ty + 1) * TILE_SIZE, zoomed_h)) / self.zoom
+        xs = np.minimum(xs.astype(np.intp), width - 1)
+        ys = np.minimum(ys.astype(np.intp), height - 1)
+        tile = array[ys[:, None], xs]
+
+        self.cache[cache_key] = tile
+        self.cache_bytes += tile.nbytes
+        while self.cache_bytes > TILE_CACHE_MAX_BYTES and len(self.cache) > 1:
+            self.cache_bytes -= self.cache.popitem(last=False)[1].nbytes
+        return tile
+
+
+# ==================== Recording ====================
+
+class FillRecording:
+    """Event timeline of a coloring session; frames are rendered at export.
+
+    A capture stores only the regions whose state changed since the last
+    one, as (timestamp, region_id, color) events with color None for a
+    region that was uncolored again. Capturing an unchanged picture extends
+    the previous frame's hold instead of adding a frame.
+    """
+
+    def __init__(self, compositor, regions, colored_flags):
+        self.template = compositor.template
+        self.regions = regions
+        self.start_frame = compositor.template_view(colored_flags).copy()
+        self.flags = colored_flags.copy()
+        self.events = []
+        self.frames = []  # [event count, hold] per distinct frame
+        self.frame_count = 0
+        self.start_time = time.time()
+
+    def capture(self, colored_flags, color_palette, hold=1):
+        """Record the current coloring; returns the events it added"""
+        changed = np.flatnonzero(colored_flags != self.flags)
+        first = len(self.events)
+        if len(changed) or not self.frames:
+            timestamp = time.time() - self.start_time
+            for region_id in changed:
+                color = color_palette[self.regions.color_num(region_id)] if colored_flags[region_id] else None
+                self.events.append((timestamp, int(region_id), color))
+            self.flags[changed] = colored_flags[changed]
+            self.frames.append([len(self.events), hold])
+        else:
+            self.frames[-1][1] += hold
+        self.frame_count += hold
+        return self.events[first:]
+
+    def apply_events(self, frame, events):
+        for _, region_id, color in events:
+            slices, mask = self.regions.mask(region_id)
+            frame[slices][mask] = self.template[slices][mask] if color is None else color
+
+    def iter_frames(self):
+        """Yield (frame, hold) in order.
+
+        frame is a single array updated in place between steps, so consume
+        or copy it before advancing.
+        """
+        frame = self.start_frame.copy()
+        applied = 0
+        for count, hold in self.frames:
+            self.apply_events(frame, self.events[applied:count])
+            applied = count
+            yield frame, hold
+
+
+class FrameGeometry:
+    """Precomputed resize (and letterbox) from recording size to export size"""
+
+    def __init__(self, src_size, out_size, letterbox=True, fill=(255, 255, 255), bgr=True):
+        src_w, src_h = src_size
+        out_w, out_h = out_size
+        if letterbox:
+            scale = min(out_w / src_w, out_h / src_h)
+            self.size = (min(out_w, max(1, round(src_w * scale))), min(out_h, max(1, round(src_h * scale))))
+        else:
+            self.size = (out_w, out_h)
+        self.src_size = (src_w, src_h)
+        self.out_size = (out_w, out_h)
+        self.offset = ((out_w - self.size[0]) // 2, (out_h - self.size[1]) // 2)
+        self.interpolation = cv2.INTER_AREA if self.size[0] < src_w else cv2.INTER_LINEAR
+        self.bgr = bgr
+        self.fill = fill[::-1] if bgr else fill
+        self.canvas = self.new_canvas()
+
+    def new_canvas(self):
+        """Output-sized frame pre-filled with the letterbox color"""
+        canvas = np.empty((self.out_size[1], self.out_size[0], 3), dtype=np.uint8)
+        canvas[:] = self.fill
+        return canvas
+
+    def apply(self, frame_rgb, canvas=None):
+        """Output frame, written into canvas (default: one reused by every call)"""
+        if canvas is None:
+            canvas = self.canvas
+        if self.size != self.src_size:
+            frame_rgb = cv2.resize(frame_rgb, self.size, interpolation=self.interpolation)
+        x, y = self.offset
+        canvas[y:y + self.size[1], x:x + self.size[0]] = (
+            cv2.cvtColor(frame_rgb, cv2.COLOR_RGB2BGR) if self.bgr else frame_rgb
+        )
+        return canvas
+
+
+EXPORT_WORKER_CHOICES = ("Auto", "1", "2", "4", "8", "16")
+LIVE_ENCODE_QUEUE_SIZE = 64
+
+
+def export_frames(frames, prepare, write, workers=None):
+    """Run prepare over timeline frames on a thread pool, writing results in order.
+
+    frames yields (frame, hold) with an array reused between steps, so each
+    frame is copied before it goes to the pool. Futures wait in submission
+    order, which makes the deque a reorder buffer; at most 2 * workers
+    frames are in flight. Returns (frames written, seconds).
+    """
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    written = 0
+    pending = deque()
+
+    def write_next():
+        nonlocal written
+        future, hold = pending.popleft()
+        write(future.result(), hold)
+        written += hold
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for frame, hold in frames:
+            pending.append((pool.submit(prepare, frame.copy()), hold))
+            while pending and (len(pending) >= 2 * workers or pending[0][0].done()):
+                write_next()
+        while pending:
+            write_next()
+
+    return written, time.perf_counter() - start
+
+
+class VideoEncoder:
+    """Encodes a recording on a background thread while it is captured.
+
+    The bounded queue carries (events, hold) steps rather than pixels: the
+    thread replays events onto its own frame, maps it through a FrameGeometry
+    and writes it hold times. A slow encoder throttles capture instead of
+    growing memory.
+    """
+
+    def __init__(self, writer, recording, geometry, queue_size=LIVE_ENCODE_QUEUE_SIZE):
+        self.writer = writer
+        self.recording = recording
+        self.geometry = geometry
+        self.frame = recording.start_frame.copy()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, events, hold):
+        self.queue.put((events, hold))
+
+    def close(self):
+        """Wait for queued frames to be written; re-raises an encoding error"""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        try:
+            while True:
+                step = self.queue.get()
+                if step is None:
+                    break
+                events, hold = step
+                self.recording.apply_events(self.frame, events)
+                video_frame = self.geometry.apply(self.frame)
+                for _ in range(hold):
+                    self.writer.write(video_frame)
+        except Exception as e:
+            self.error = e
+            # Keep consuming so submit() never blocks on a dead encoder
+            while self.queue.get() is not None:
+                pass
+        finally:
+            self.writer.release()
+
+
+GIF_TRANSPARENT_INDEX = 255
+GIF_LUT_BITS = 6
+
+
+def build_gif_palette(colors):
+    """Global GIF palette for a recording, plus a LUT from 6-bit RGB to it.
+
+    Entries are the fill colors, their blends with the template edge color
+    (what downscaled borders turn into) and a gray ramp for the template
+    itself. Index 255 is kept free for transparency.
+    """
+    fills = [tuple(int(v) for v in c) for c in colors]
+    anchors = list(dict.fromkeys(fills + [TEMPLATE_EDGE_COLOR, (255, 255, 255)]))[:GIF_TRANSPARENT_INDEX]
+    edge = np.array(TEMPLATE_EDGE_COLOR, dtype=np.float64)
+    blends = [
+        tuple(int(v) for v in np.rint(np.array(c) * w + edge * (1 - w)))
+        for w in (2 / 3, 1 / 3) for c in fills
+    ]
+    entries = list(dict.fromkeys(anchors + blends))[:GIF_TRANSPARENT_INDEX]
+    grays = np.rint(np.linspace(0, 255, max(2, GIF_TRANSPARENT_INDEX - len(entries)))).astype(int)
+    entries = list(dict.fromkeys(entries + [(g, g, g) for g in grays]))[:GIF_TRANSPARENT_INDEX]
+
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    palette[:len(entries)] = entries
+
+    # Nearest entry for the center of every 6-bit RGB cell
+    step = 1 << (8 - GIF_LUT_BITS)
+    levels = np.arange(1 << GIF_LUT_BITS, dtype=np.float32) * step + step / 2
+    centers = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)
+    targets = palette[:len(entries)].astype(np.float32)
+    norms = (targets ** 2).sum(axis=1)
+    lut = np.empty(len(centers), dtype=np.uint8)
+    for start in range(0, len(centers), QUANTIZE_CHUNK_SIZE):
+        chunk = centers[start:start + QUANTIZE_CHUNK_SIZE]
+        lut[start:start + len(chunk)] = np.argmin(norms - 2.0 * (chunk @ targets.T), axis=1)
+
+    # Exact fill and edge colors always map to themselves
+    for index, color in reversed(list(enumerate(anchors))):
+        lut[gif_codes(np.array([color], dtype=np.uint8))[0]] = index
+    return palette, lut
+
+
+def gif_codes(rgb):
+    bits = GIF_LUT_BITS
+    q = (rgb >> (8 - bits)).astype(np.uint32)
+    return (q[..., 0] << (2 * bits)) | (q[..., 1] << bits) | q[..., 2]
+
+
+class GifWriter:
+    """Streams GIF frames that share one global palette.
+
+    After the first frame only the bbox of changed pixels is written, with
+    unchanged pixels inside it transparent and disposal 1 keeping the
+    previous frame underneath. Each frame is held back until the next one
+    arrives, so a frame that changes nothing only extends its duration.
+    """
+
+    def __init__(self, fp, palette, size, loop=0):
+        self.fp = fp
+        self.palette_bytes = palette.tobytes()
+        self.previous = None
+        self.pending = None  # [image, offset, duration]
+
+        header, _ = GifImagePlugin.getheader(self._image(np.zeros(size[::-1], dtype=np.uint8)), None, {'loop': loop})
+        for chunk in header:
+            fp.write(chunk)
+
+    def _image(self, indices):
+        image = Image.frombytes('P', indices.shape[::-1], np.ascontiguousarray(indices).tobytes())
+        image.putpalette(self.palette_bytes)
+        return image
+
+    def add(self, indices, duration):
+        """Append a frame of palette indices shown for duration ms"""
+        if self.previous is None:
+            image, offset = self._image(indices), (0, 0)
+        else:
+            changed = indices != self.previous
+            rows = np.flatnonzero(changed.any(axis=1))
+            if not len(rows):
+                self.pending[2] += duration
+                return
+            cols = np.flatnonzero(changed.any(axis=0))
+            y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+            delta = np.where(changed[y0:y1, x0:x1], indices[y0:y1, x0:x1], GIF_TRANSPARENT_INDEX)
+            image, offset = self._image(delta.astype(np.uint8)), (int(x0), int(y0))
+
+        self._flush()
+        self.pending = [image, offset, duration]
+        self.previous = indices
+
+    def _flush(self):
+        if self.pending:
+            image, offset, duration = self.pending
+            for chunk in GifImagePlugin.getdata(image, offset, duration=duration, disposal=1,
+                                                transparency=GIF_TRANSPARENT_INDEX):
+                self.fp.write(chunk)
+            self.pending = None
+
+    def close(self):
+        self._flush()
+        self.fp.write(b";")
+
+
+MAX_IMAGE_SIZE_CHOICES = ("800", "1600", "2400", "4000", "Full")
+
+
 class ColorByNumberApp:
     def __init__(self, root):
         self.root = root
@@ -52,19 +2196,19 @@ class ColorByNumberApp:
 
         # App state
         self.original_image = None
-        self.processed_image = None
+        self.compositor = None
         self.template_image = None
-        self.display_image = None
+        self.framebuffer = FrameBuffer()
         self.color_palette = {}
         self.original_colors = {}
         self.regions = None
         self.region_labels = None
-        self.colored_regions = {}
+        self.registry = RegionRegistry()
+        self.colored_regions = self.registry.colored
         self.selected_color_num = None
         self.zoom_level = 1.0
         self.pan_offset = [0, 0]
-        self.history = []
-        self.history_index = -1
+        self.history = FillHistory()
         self.num_colors = 10
 
         # View mode
@@ -78,13 +2222,17 @@ class ColorByNumberApp:
 
         # Recording state
         self.is_recording = False
-        self.recorded_frames = []
+        self.recording = None
+        self.video_encoder = None
+        self.live_video = None  # {'path', 'settings'} of the live-encoded file
         self.record_fps = 10
         self.record_start_time = None
 
         # Recording output options
         self.rec_resolution_var = ctk.StringVar(value="Original")
         self.rec_quality_var = ctk.StringVar(value="High")
+        self.live_encode = ctk.BooleanVar(value=False)
+        self.export_workers_var = ctk.StringVar(value="Auto")
 
         # Canvas drag state
         self.drag_start = None
@@ -94,6 +2242,23 @@ class ColorByNumberApp:
         self.use_exact_colors = ctk.BooleanVar(value=True)
         self.fill_micro_holes = ctk.BooleanVar(value=True)
         self.min_region_size = ctk.IntVar(value=30)
+        self.quantize_mode = ctk.StringVar(value="exact")
+        self.histogram_bits = ctk.IntVar(value=8)
+        self.incremental_quantize = ctk.BooleanVar(value=True)
+        self.progressive_preview = ctk.BooleanVar(value=True)
+        self.template_is_preview = False
+        self.engine_mode = ctk.StringVar(value="thread")
+        self.prefilter_label = ctk.StringVar(value=PREFILTER_LABELS["bilateral"])
+        self.max_image_size_var = ctk.StringVar(value="800")
+        self.quantize_stats = None
+
+        # Generated template cache and memoized generation stages
+        self.template_cache = TemplateCache()
+        # Memory tracing would stall the UI thread while generation runs in the background
+        self.pipeline = TemplatePipeline(trace_memory=False)
+        self.generator = TemplateGenerator(self.pipeline, self.template_cache)
+        self.generation_done = None
+        self.generation_polling = False
 
         # Slider variables
         self.color_count_var = ctk.IntVar(value=10)
@@ -264,6 +2429,17 @@ class ColorByNumberApp:
         )
         self.generate_btn.pack(fill=tk.X, pady=(10, 0))
 
+        self.cancel_generate_btn = ctk.CTkButton(
+            content,
+            text="✖ Cancel",
+            command=self.cancel_generation,
+            height=28,
+            corner_radius=8,
+            state="disabled",
+            fg_color=self.colors['bg_light']
+        )
+        self.cancel_generate_btn.pack(fill=tk.X, pady=(5, 0))
+
     def setup_advanced_section(self):
         content = self.create_section_frame(self.left_scrollable, "Advanced Options", "🔧")
 
@@ -283,6 +2459,123 @@ class ColorByNumberApp:
         )
         self.fill_holes_cb.pack(anchor=tk.W, pady=3)
 
+        self.incremental_cb = ctk.CTkCheckBox(
+            content,
+            text="Reuse clusters when color count changes",
+            variable=self.incremental_quantize,
+            font=ctk.CTkFont(size=12)
+        )
+        self.incremental_cb.pack(anchor=tk.W, pady=3)
+
+        self.preview_cb = ctk.CTkCheckBox(
+            content,
+            text="Show a quick preview while generating",
+            variable=self.progressive_preview,
+            font=ctk.CTkFont(size=12)
+        )
+        self.preview_cb.pack(anchor=tk.W, pady=3)
+
+        # Quantization mode
+        quant_frame = ctk.CTkFrame(content, fg_color="transparent")
+        quant_frame.pack(fill=tk.X, pady=5)
+
+        ctk.CTkLabel(
+            quant_frame,
+            text="Quantization:",
+            font=ctk.CTkFont(size=12)
+        ).pack(anchor=tk.W, pady=(0, 5))
+
+        quant_row = ctk.CTkFrame(quant_frame, fg_color="transparent")
+        quant_row.pack(fill=tk.X)
+
+        for text, value in [("Exact", "exact"), ("Fast", "fast"), ("Histogram", "histogram")]:
+            ctk.CTkRadioButton(
+                quant_row,
+                text=text,
+                variable=self.quantize_mode,
+                value=value,
+                font=ctk.CTkFont(size=11)
+            ).pack(side=tk.LEFT, padx=5)
+
+        bits_row = ctk.CTkFrame(quant_frame, fg_color="transparent")
+        bits_row.pack(fill=tk.X, pady=(5, 0))
+
+        ctk.CTkLabel(
+            bits_row,
+            text="Histogram bins:",
+            font=ctk.CTkFont(size=11)
+        ).pack(side=tk.LEFT, padx=(0, 5))
+
+        for bits in HISTOGRAM_BITS:
+            ctk.CTkRadioButton(
+                bits_row,
+                text=f"{bits}-bit",
+                variable=self.histogram_bits,
+                value=bits,
+                font=ctk.CTkFont(size=11)
+            ).pack(side=tk.LEFT, padx=5)
+
+        # Input size cap, applied when an image is loaded
+        cap_frame = ctk.CTkFrame(content, fg_color="transparent")
+        cap_frame.pack(fill=tk.X, pady=5)
+
+        ctk.CTkLabel(
+            cap_frame, text="Max image size on load:",
+            font=ctk.CTkFont(size=12)
+        ).pack(side=tk.LEFT)
+
+        self.max_image_size_combo = ctk.CTkComboBox(
+            cap_frame,
+            variable=self.max_image_size_var,
+            values=list(MAX_IMAGE_SIZE_CHOICES),
+            state="readonly",
+            width=100,
+            height=30
+        )
+        self.max_image_size_combo.pack(side=tk.RIGHT)
+
+        # Prefilter strategy
+        prefilter_frame = ctk.CTkFrame(content, fg_color="transparent")
+        prefilter_frame.pack(fill=tk.X, pady=5)
+
+        ctk.CTkLabel(
+            prefilter_frame,
+            text="Smoothing:",
+            font=ctk.CTkFont(size=12)
+        ).pack(anchor=tk.W, pady=(0, 5))
+
+        self.prefilter_combo = ctk.CTkComboBox(
+            prefilter_frame,
+            variable=self.prefilter_label,
+            values=[PREFILTER_LABELS[mode] for mode in PREFILTER_MODES],
+            state="readonly",
+            width=250,
+            height=30
+        )
+        self.prefilter_combo.pack(fill=tk.X, pady=2)
+
+        # Generation engine
+        engine_frame = ctk.CTkFrame(content, fg_color="transparent")
+        engine_frame.pack(fill=tk.X, pady=5)
+
+        ctk.CTkLabel(
+            engine_frame,
+            text="Engine:",
+            font=ctk.CTkFont(size=12)
+        ).pack(anchor=tk.W, pady=(0, 5))
+
+        engine_row = ctk.CTkFrame(engine_frame, fg_color="transparent")
+        engine_row.pack(fill=tk.X)
+
+        for text, value in [("Thread", "thread"), ("Process", "process")]:
+            ctk.CTkRadioButton(
+                engine_row,
+                text=text,
+                variable=self.engine_mode,
+                value=value,
+                font=ctk.CTkFont(size=11)
+            ).pack(side=tk.LEFT, padx=5)
+
         # Min region size
         size_frame = ctk.CTkFrame(content, fg_color="transparent")
         size_frame.pack(fill=tk.X, pady=5)
@@ -480,6 +2773,33 @@ class ColorByNumberApp:
         )
         self.fps_label.pack(side=tk.RIGHT)
 
+        self.live_encode_cb = ctk.CTkCheckBox(
+            content,
+            text="Encode video while recording",
+            variable=self.live_encode,
+            font=ctk.CTkFont(size=12)
+        )
+        self.live_encode_cb.pack(anchor=tk.W, pady=3)
+
+        # Export threads
+        workers_frame = ctk.CTkFrame(content, fg_color="transparent")
+        workers_frame.pack(fill=tk.X, pady=3)
+
+        ctk.CTkLabel(
+            workers_frame, text="Export threads:",
+            font=ctk.CTkFont(size=12)
+        ).pack(side=tk.LEFT)
+
+        self.export_workers_combo = ctk.CTkComboBox(
+            workers_frame,
+            variable=self.export_workers_var,
+            values=list(EXPORT_WORKER_CHOICES),
+            state="readonly",
+            width=100,
+            height=30
+        )
+        self.export_workers_combo.pack(side=tk.RIGHT)
+
         # Record buttons
         rec_btn_frame = ctk.CTkFrame(content, fg_color="transparent")
         rec_btn_frame.pack(fill=tk.X, pady=5)
@@ -643,6 +2963,7 @@ class ColorByNumberApp:
             highlightthickness=0
         )
         self.canvas.pack(fill=tk.BOTH, expand=True)
+        self.tile_renderer = TileRenderer(self.canvas)
 
         # Instructions
         self.instructions = ctk.CTkLabel(
@@ -754,6 +3075,7 @@ class ColorByNumberApp:
         self.canvas.bind("<B3-Motion>", self.do_pan)
         self.canvas.bind("<ButtonRelease-3>", self.end_pan)
         self.canvas.bind("<MouseWheel>", self.on_mousewheel)
+        self.canvas.bind("<Configure>", lambda e: self.update_canvas())
 
         self.root.bind("<Control-z>", lambda e: self.undo())
         self.root.bind("<Control-y>", lambda e: self.redo())
@@ -790,19 +3112,11 @@ class ColorByNumberApp:
         mode = self.view_mode.get()
 
         if mode == "original" and self.original_image:
-            self.display_image = self.original_image.copy()
-        elif mode == "template" and self.template_image:
-            self.display_image = self.template_image.copy()
-            if self.colored_regions:
-                img_array = np.array(self.display_image)
-                for region_id in self.colored_regions:
-                    if self.regions and region_id in self.regions:
-                        region_info = self.regions[region_id]
-                        color = self.color_palette[region_info['color_num']]
-                        img_array[region_info['mask']] = color
-                self.display_image = Image.fromarray(img_array)
-        elif mode == "progress" and self.processed_image:
-            self.display_image = self.processed_image.copy()
+            self.framebuffer.load(self.original_image)
+        elif mode == "template" and self.compositor:
+            self.framebuffer.load(self.compositor.template_view(self.registry.flags))
+        elif mode == "progress" and self.compositor:
+            self.framebuffer.load(self.compositor.progress_view())
 
         self.update_canvas()
 
@@ -862,8 +3176,8 @@ class ColorByNumberApp:
                 self.set_status("Loading image...", "info")
                 self.original_image = Image.open(file_path).convert("RGB")
 
-                max_size = 800
-                if max(self.original_image.size) > max_size:
+                max_size = self.max_image_size()
+                if max_size and max(self.original_image.size) > max_size:
                     ratio = max_size / max(self.original_image.size)
                     new_size = (int(self.original_image.width * ratio),
                                 int(self.original_image.height * ratio))
@@ -877,6 +3191,10 @@ class ColorByNumberApp:
                 self.set_status(f"Failed to load image: {str(e)}", "error")
                 messagebox.showerror("Error", f"Failed to load image: {str(e)}")
 
+    def max_image_size(self):
+        choice = self.max_image_size_var.get()
+        return int(choice) if choice.isdigit() else None
+
     def update_preview(self):
         if self.original_image:
             preview = self.original_image.copy()
@@ -888,290 +3206,175 @@ class ColorByNumberApp:
 
     def display_original(self):
         if self.original_image:
-            self.display_image = self.original_image.copy()
+            self.framebuffer.load(self.original_image)
             self.view_mode.set("original")
             self.update_canvas()
 
-    def generate_template(self):
+    def generate_template(self, on_done=None, quantize_labels=None):
+        """Start building a template in the background; on_done runs once it is shown"""
         if not self.original_image:
             messagebox.showwarning("Warning", "Please load an image first!")
             return
 
-        try:
-            self.set_status("Generating template...", "info")
-            self.root.config(cursor="wait")
-            self.root.update()
-
-            self.stop_animation()
-
-            img_array = np.array(self.original_image)
-
-            img_filtered = cv2.bilateralFilter(img_array, 9, 75, 75)
-            pixels = img_filtered.reshape(-1, 3)
-
-            n_colors = self.num_colors
-            kmeans = KMeans(n_clusters=n_colors, random_state=42, n_init=10, max_iter=300)
-            labels = kmeans.fit_predict(pixels)
-
-            cluster_centers = kmeans.cluster_centers_.astype(int)
-
-            self.color_palette = {}
-            self.original_colors = {}
-
-            for i in range(n_colors):
-                cluster_mask = (labels == i)
-                cluster_pixels = pixels[cluster_mask]
-
-                if self.use_exact_colors.get() and len(cluster_pixels) > 0:
-                    pixel_tuples = [tuple(p) for p in cluster_pixels]
-                    color_counts = Counter(pixel_tuples)
-
-                    top_colors = color_counts.most_common(min(10, len(color_counts)))
-                    centroid = cluster_centers[i]
-                    best_color = top_colors[0][0]
-                    best_dist = float('inf')
-
-                    most_common_count = color_counts.most_common(1)[0][1]
-                    for color, count in top_colors:
-                        dist = np.sqrt(sum((c1 - c2) ** 2 for c1, c2 in zip(color, centroid)))
-                        if count > most_common_count * 0.5:
-                            if dist < best_dist:
-                                best_dist = dist
-                                best_color = color
+        self.stop_animation()
+        self.generator.submit(
+            np.array(self.original_image), self.get_generation_params(), self.engine_mode.get(), quantize_labels
+        )
+        self.generation_done = on_done
 
-                    median_color = tuple(np.median(cluster_pixels, axis=0).astype(int))
-                    best_sat = max(best_color) - min(best_color)
-                    median_sat = max(median_color) - min(median_color)
+        self.cancel_generate_btn.configure(state="normal")
+        self.set_status("Generating template...", "info")
+        if not self.generation_polling:
+            self.generation_polling = True
+            self.root.after(GENERATION_POLL_MS, self.poll_generation)
 
-                    final_color = median_color if median_sat > best_sat * 1.2 else best_color
-                    self.color_palette[i + 1] = final_color
+    def poll_generation(self):
+        try:
+            for job_id, kind, payload in self.generator.poll():
+                # set_status pumps Tk events, so the job may have been superseded or cancelled since
+                if not self.generator.is_current(job_id):
+                    continue
+                if kind == 'progress':
+                    stage, index, total = payload
+                    self.set_status(f"Generating template... {stage} ({index + 1}/{total})", "info")
+                elif kind == 'preview':
+                    self.apply_template(payload, preview=True)
+                elif kind == 'done':
+                    self.apply_template(payload)
                 else:
-                    self.color_palette[i + 1] = tuple(cluster_centers[i])
-
-                self.original_colors[i + 1] = tuple(cluster_centers[i])
-
-            self.region_labels = labels.reshape(img_array.shape[:2])
-
-            self.regions = self.create_regions()
-
-            if self.fill_micro_holes.get():
-                self.fill_remaining_holes()
-
-            self.create_template_image()
-            self.processed_image = self.create_colored_image()
-
-            self.colored_regions = {}
-            self.history = []
-            self.history_index = -1
-            self.recorded_frames = []
-
-            self.update_palette()
-            self.view_mode.set("template")
-            self.update_canvas()
-            self.update_progress()
-
-            self.root.config(cursor="")
-            self.region_count_label.configure(text=f"Regions: {len(self.regions)}")
-            self.set_status(f"Template generated: {n_colors} colors, {len(self.regions)} regions", "success")
-
-        except Exception as e:
-            self.root.config(cursor="")
-            self.set_status(f"Failed to generate template: {str(e)}", "error")
-            messagebox.showerror("Error", f"Failed to generate template: {str(e)}")
-
-    def create_colored_image(self):
-        height, width = self.region_labels.shape
-        colored = np.zeros((height, width, 3), dtype=np.uint8)
-
-        for color_num, color in self.color_palette.items():
-            mask = (self.region_labels == (color_num - 1))
-            colored[mask] = color
-
-        return Image.fromarray(colored)
-
-    def create_regions(self):
-        regions = {}
-        region_id = 0
-        min_size = self.min_region_size.get()
-
-        height, width = self.region_labels.shape
-        all_assigned = np.zeros((height, width), dtype=bool)
-
-        for color_num in range(self.num_colors):
-            mask = (self.region_labels == color_num).astype(np.uint8)
-
-            kernel = np.ones((3, 3), np.uint8)
-            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=2)
-
-            labeled, num_features = ndimage.label(mask)
-
-            for i in range(1, num_features + 1):
-                region_mask = (labeled == i)
-                region_size = np.sum(region_mask)
+                    self.set_status(f"Failed to generate template: {str(payload)}", "error")
+                    messagebox.showerror("Error", f"Failed to generate template: {str(payload)}")
+        finally:
+            if self.generator.busy:
+                self.root.after(GENERATION_POLL_MS, self.poll_generation)
+            else:
+                self.generation_polling = False
+                self.cancel_generate_btn.configure(state="disabled")
 
-                if region_size >= min_size:
-                    filled_mask = ndimage.binary_fill_holes(region_mask)
-                    centroid = ndimage.center_of_mass(filled_mask)
+    def cancel_generation(self):
+        if self.generator.cancel():
+            self.generation_done = None
+            self.set_status("Template generation cancelled", "warning")
+        self.cancel_generate_btn.configure(state="disabled")
 
-                    regions[region_id] = {
-                        'mask': filled_mask,
-                        'color_num': color_num + 1,
-                        'size': int(np.sum(filled_mask)),
-                        'centroid': centroid
-                    }
+    def apply_template(self, result, preview=False):
+        self.stop_animation()
 
-                    all_assigned |= filled_mask
-                    region_id += 1
+        # Regions colored on a preview carry over to the refined template
+        carried = None
+        if self.template_is_preview and self.registry.done_count:
+            carried = (self.regions, self.registry.flags.copy())
+        self.template_is_preview = preview
+
+        self.region_labels = result['region_labels']
+        self.color_palette = result['color_palette']
+        self.original_colors = result['original_colors']
+        self.regions = result['regions']
+        self.template_image = result['template_image']
+        self.quantize_stats = result['quantize_stats']
+        self.framebuffer.load(self.template_image)
+
+        self.compositor = ViewCompositor(
+            np.array(self.template_image), self.region_labels, self.regions, self.color_palette
+        )
 
-        orphan_mask = ~all_assigned
-        if np.any(orphan_mask):
-            self.assign_orphan_pixels(regions, orphan_mask)
+        self.registry = RegionRegistry(self.regions)
+        self.colored_regions = self.registry.colored
+        self.history = FillHistory()
+        self.discard_recording()
+        if carried is not None:
+            self.carry_over_colored(*carried)
 
-        return regions
+        self.update_palette()
+        self.update_palette_progress()
+        self.view_mode.set("template")
+        self.update_canvas()
+        self.update_progress()
 
-    def assign_orphan_pixels(self, regions, orphan_mask):
-        if not regions:
+        self.region_count_label.configure(
+            text=f"Regions: {len(self.regions)} ({self.regions.nbytes / 1e6:.1f}MB)"
+        )
+        if preview:
+            self.set_status(
+                f"Preview ready in {result['preview_time']:.2f}s, refining at full resolution...", "info"
+            )
             return
+        self.set_status(
+            f"Template generated: {len(self.color_palette)} colors, {len(self.regions)} regions "
+            f"({format_pipeline_stats(result)})",
+            "success"
+        )
 
-        height, width = orphan_mask.shape
-
-        all_regions_mask = np.zeros((height, width), dtype=np.int32)
-        for region_id, region_info in regions.items():
-            all_regions_mask[region_info['mask']] = region_id + 1
-
-        for _ in range(10):
-            kernel = np.ones((3, 3), np.uint8)
-            dilated = cv2.dilate(all_regions_mask.astype(np.uint8), kernel, iterations=1)
-
-            new_assignments = dilated.astype(np.int32)
-            new_assignments[all_regions_mask > 0] = all_regions_mask[all_regions_mask > 0]
-
-            for region_id, region_info in regions.items():
-                new_mask = (new_assignments == region_id + 1)
-                if np.sum(new_mask) > np.sum(region_info['mask']):
-                    region_info['mask'] = new_mask
-                    region_info['size'] = int(np.sum(new_mask))
-
-            all_regions_mask = new_assignments
-
-            if not np.any((all_regions_mask == 0) & orphan_mask):
-                break
+        on_done, self.generation_done = self.generation_done, None
+        if on_done:
+            on_done()
 
-    def fill_remaining_holes(self):
-        if not self.regions:
+    def carry_over_colored(self, old_regions, old_flags):
+        """Color each region whose centroid lies in an old region colored with the same number"""
+        if old_regions.region_map.shape != self.regions.region_map.shape:
             return
 
-        height, width = self.region_labels.shape
-        assigned = np.zeros((height, width), dtype=bool)
-
-        for region_info in self.regions.values():
-            assigned |= region_info['mask']
-
-        unassigned = ~assigned
-
-        if np.any(unassigned):
-            unassigned_coords = np.where(unassigned)
-
-            for y, x in zip(unassigned_coords[0], unassigned_coords[1]):
-                original_label = self.region_labels[y, x]
-                target_color = original_label + 1
-
-                best_region = None
-                best_dist = float('inf')
-
-                for region_id, region_info in self.regions.items():
-                    if region_info['color_num'] == target_color:
-                        cy, cx = region_info['centroid']
-                        dist = (y - cy) ** 2 + (x - cx) ** 2
-                        if dist < best_dist:
-                            best_dist = dist
-                            best_region = region_id
-
-                if best_region is None:
-                    for region_id, region_info in self.regions.items():
-                        cy, cx = region_info['centroid']
-                        dist = (y - cy) ** 2 + (x - cx) ** 2
-                        if dist < best_dist:
-                            best_dist = dist
-                            best_region = region_id
-
-                if best_region is not None:
-                    mask = self.regions[best_region]['mask'].copy()
-                    mask[y, x] = True
-                    self.regions[best_region]['mask'] = mask
-                    self.regions[best_region]['size'] += 1
+        height, width = self.regions.region_map.shape
+        ys = np.clip(self.regions.centroids[:, 0].astype(np.int64), 0, height - 1)
+        xs = np.clip(self.regions.centroids[:, 1].astype(np.int64), 0, width - 1)
+        old_ids = old_regions.region_map[ys, xs]
+        hit = old_ids >= 0
+        hit[hit] = old_flags[old_ids[hit]] & (old_regions.color_nums[old_ids[hit]] == self.regions.color_nums[hit])
 
-    def create_template_image(self):
-        height, width = self.region_labels.shape
+        self.set_colored_regions({int(r): int(self.regions.color_nums[r]) for r in np.flatnonzero(hit)})
+        self.framebuffer.load(self.compositor.template_view(self.registry.flags))
 
-        self.template_image = Image.new('RGB', (width, height), 'white')
-
-        edges = self.detect_edges()
-
-        template_array = np.array(self.template_image)
-        template_array[edges] = [60, 60, 60]
-
-        assigned = np.zeros((height, width), dtype=bool)
-        for region_info in self.regions.values():
-            assigned |= region_info['mask']
-
-        if np.any(~assigned):
-            unassigned_coords = np.where(~assigned)
-            for y, x in zip(unassigned_coords[0], unassigned_coords[1]):
-                if not edges[y, x]:
-                    template_array[y, x] = [240, 240, 240]
-
-        self.template_image = Image.fromarray(template_array)
-        draw = ImageDraw.Draw(self.template_image)
-
-        try:
-            font_size = max(10, min(width, height) // 50)
-            font = ImageFont.truetype("arial.ttf", font_size)
-            small_font = ImageFont.truetype("arial.ttf", max(8, font_size - 2))
-        except Exception:
-            font = ImageFont.load_default()
-            small_font = font
-
-        for region_id, region_info in self.regions.items():
-            centroid = region_info['centroid']
-            color_num = region_info['color_num']
-            size = region_info['size']
-
-            if size > 500:
-                use_font = font
-            elif size > 200:
-                use_font = small_font
-            else:
-                continue
-
-            y, x = int(centroid[0]), int(centroid[1])
-            text = str(color_num)
-
-            bbox = draw.textbbox((x, y), text, font=use_font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-
-            text_x = x - text_width // 2
-            text_y = y - text_height // 2
-
-            if 0 <= y < height and 0 <= x < width:
-                for dx in [-1, 0, 1]:
-                    for dy in [-1, 0, 1]:
-                        if dx != 0 or dy != 0:
-                            draw.text((text_x + dx, text_y + dy), text, fill='white', font=use_font)
-                draw.text((text_x, text_y), text, fill='#333333', font=use_font)
-
-        self.display_image = self.template_image.copy()
+    def get_generation_params(self):
+        return {
+            'num_colors': self.num_colors,
+            'min_region_size': self.min_region_size.get(),
+            'use_exact_colors': self.use_exact_colors.get(),
+            'fill_micro_holes': self.fill_micro_holes.get(),
+            'quantize_mode': self.quantize_mode.get(),
+            'histogram_bits': self.histogram_bits.get(),
+            'incremental_quantize': self.incremental_quantize.get(),
+            'progressive_preview': self.progressive_preview.get(),
+            'prefilter': self.prefilter_mode(),
+        }
 
-    def detect_edges(self):
-        """THIN (1-pixel) region borders."""
-        labels = self.region_labels.astype(np.int32)
-        h, w = labels.shape
-        edges = np.zeros((h, w), dtype=bool)
+    def prefilter_mode(self):
+        label = self.prefilter_label.get()
+        return next((mode for mode, text in PREFILTER_LABELS.items() if text == label), "bilateral")
+
+    def apply_generation_params(self, params):
+        if 'min_region_size' in params:
+            self.min_region_size.set(params['min_region_size'])
+            self.size_label.configure(text=str(params['min_region_size']))
+        if 'use_exact_colors' in params:
+            self.use_exact_colors.set(params['use_exact_colors'])
+        if 'fill_micro_holes' in params:
+            self.fill_micro_holes.set(params['fill_micro_holes'])
+        if 'incremental_quantize' in params:
+            self.incremental_quantize.set(params['incremental_quantize'])
+        if 'progressive_preview' in params:
+            self.progressive_preview.set(params['progressive_preview'])
+        if params.get('quantize_mode') in QUANTIZE_MODES:
+            self.quantize_mode.set(params['quantize_mode'])
+        if params.get('histogram_bits') in HISTOGRAM_BITS:
+            self.histogram_bits.set(params['histogram_bits'])
+        if params.get('prefilter') in PREFILTER_MODES:
+            self.prefilter_label.set(PREFILTER_LABELS[params['prefilter']])
+
+    def set_palette(self, color_palette):
+        """Swap in new palette colors and recomposite the current view"""
+        self.color_palette = color_palette
+        self.compositor.set_palette(color_palette)
+        self.update_palette()
+        self.update_palette_progress()
+        if self.selected_color_num in color_palette:
+            self.select_color(self.selected_color_num)
+        self.update_view_mode()
 
-        edges[:, :-1] |= (labels[:, :-1] != labels[:, 1:])
-        edges[:-1, :] |= (labels[:-1, :] != labels[1:, :])
-        return edges
+    def edit_palette_color(self, color_num):
+        initial = '#{:02x}{:02x}{:02x}'.format(*self.color_palette[color_num])
+        rgb, _ = colorchooser.askcolor(color=initial, title=f"Color #{color_num}")
+        if rgb:
+            self.set_palette({**self.color_palette, color_num: tuple(int(c) for c in rgb)})
 
     def update_palette(self):
         # Clear existing palette
@@ -1213,6 +3416,7 @@ class ColorByNumberApp:
                 command=lambda n=num: self.select_color(n)
             )
             color_btn.pack(side=tk.LEFT, padx=3)
+            color_btn.bind("<Button-3>", lambda e, n=num: self.edit_palette_color(n))
 
             # Original color indicator
             if num in self.original_colors:
@@ -1226,7 +3430,7 @@ class ColorByNumberApp:
                 orig_canvas.create_rectangle(2, 2, 13, 23, fill=orig_hex, outline='gray')
 
             # Region count
-            count = sum(1 for r in self.regions.values() if r['color_num'] == num)
+            count = self.registry.total.get(num, 0)
             count_label = ctk.CTkLabel(
                 frame,
                 text=f"({count})",
@@ -1296,8 +3500,7 @@ class ColorByNumberApp:
         clicked_region = self.find_region_at(img_x, img_y)
 
         if clicked_region is not None:
-            region_info = self.regions[clicked_region]
-            correct_color = region_info['color_num']
+            correct_color = self.regions.color_num(clicked_region)
 
             if self.selected_color_num == correct_color:
                 self.fill_region(clicked_region)
@@ -1316,60 +3519,94 @@ class ColorByNumberApp:
         if not self.regions:
             return None
 
-        height, width = self.region_labels.shape
-        if 0 <= x < width and 0 <= y < height:
-            for region_id, region_info in self.regions.items():
-                if region_id not in self.colored_regions and region_info['mask'][y, x]:
-                    return region_id
+        region_id = self.regions.region_at(x, y)
+        if region_id is not None and not self.registry.flags[region_id]:
+            return region_id
         return None
 
+    def set_colored_regions(self, colored_regions):
+        """Replace the colored set; returns the color numbers whose progress changed"""
+        changed = self.registry.apply(colored_regions)
+        self.colored_regions = self.registry.colored
+        return changed
+
     def fill_region(self, region_id, save_history=True):
         if save_history:
-            self.save_state()
+            self.history.record_fill(region_id)
 
-        region_info = self.regions[region_id]
-        color_num = region_info['color_num']
+        color_num = self.regions.color_num(region_id)
         color = self.color_palette[color_num]
 
-        self.colored_regions[region_id] = color_num
+        self.registry.mark_colored(region_id)
 
-        img_array = np.array(self.display_image)
-        mask = region_info['mask']
-        img_array[mask] = color
-        self.display_image = Image.fromarray(img_array)
+        slices, mask = self.regions.mask(region_id)
+        self.framebuffer.paint(slices, mask, color)
 
-        self.update_palette_progress()
+        self.update_palette_progress([color_num])
 
-    def flash_region(self, region_id, color):
-        original = self.display_image.copy()
+    def unfill_region(self, region_id):
+        """Reverse fill_region: uncolor the region and restore its template pixels"""
+        if not self.registry.mark_uncolored(region_id):
+            return
 
-        region_info = self.regions[region_id]
-        img_array = np.array(self.display_image)
-        mask = region_info['mask']
+        slices, mask = self.regions.mask(region_id)
+        self.framebuffer.paint(slices, mask, self.compositor.template[slices][mask])
 
-        img_array[mask] = [255, 100, 100]
-        self.display_image = Image.fromarray(img_array)
-        self.update_canvas()
+        self.update_palette_progress([self.regions.color_num(region_id)])
 
-        self.root.after(200, lambda: self.restore_image(original))
+    def flash_region(self, region_id, color):
+        slices, mask = self.regions.mask(region_id)
+        original = self.framebuffer.read(slices, mask)
 
-    def restore_image(self, image):
-        self.display_image = image
+        self.framebuffer.paint(slices, mask, (255, 100, 100))
         self.update_canvas()
 
+        registry = self.registry
+
+        def restore():
+            # Leave it alone if the region got filled or the template was replaced meanwhile
+            if self.registry is registry and not registry.flags[region_id]:
+                self.framebuffer.paint(slices, mask, original)
+                self.update_canvas()
+
+        self.root.after(200, restore)
+
     # ==================== Animation Methods ====================
 
     def get_fill_order(self):
-        uncolored = [r for r in self.regions if r not in self.colored_regions]
+        if self.order_var.get() == "by_color":
+            uncolored = np.concatenate([
+                np.sort(self.registry.uncolored(c)) for c in sorted(self.registry.start)
+            ] or [np.zeros(0, dtype=np.int64)])
+        else:
+            uncolored = np.sort(self.registry.uncolored())
 
         if self.order_var.get() == "random":
-            random.shuffle(uncolored)
-        elif self.order_var.get() == "by_color":
-            uncolored.sort(key=lambda r: self.regions[r]['color_num'])
+            np.random.shuffle(uncolored)
         elif self.order_var.get() == "by_size":
-            uncolored.sort(key=lambda r: self.regions[r]['size'], reverse=True)
+            uncolored = uncolored[np.argsort(-self.regions.sizes[uncolored], kind='stable')]
 
-        return uncolored
+        return uncolored.tolist()
+
+    def next_uncolored_region(self):
+        """First region get_fill_order would return, without building the whole order"""
+        order = self.order_var.get()
+        if order == "random":
+            return self.registry.random_uncolored()
+
+        if order == "by_color":
+            for color_num in sorted(self.registry.start):
+                uncolored = self.registry.uncolored(color_num)
+                if len(uncolored):
+                    return int(uncolored.min())
+            return None
+
+        uncolored = np.sort(self.registry.uncolored())
+        if not len(uncolored):
+            return None
+        if order == "by_size":
+            return int(uncolored[np.argmax(self.regions.sizes[uncolored])])
+        return int(uncolored[0])
 
     def start_animation(self):
         if not self.regions:
@@ -1444,16 +3681,15 @@ class ColorByNumberApp:
         if not self.regions:
             return
 
-        uncolored = self.get_fill_order()
+        region_id = self.next_uncolored_region()
 
-        if uncolored:
-            region_id = uncolored[0]
+        if region_id is not None:
             self.fill_region(region_id)
             self.capture_frame()
             self.update_canvas()
             self.update_progress()
 
-            color_num = self.regions[region_id]['color_num']
+            color_num = self.regions.color_num(region_id)
             self.select_color(color_num)
 
             if self.check_completion():
@@ -1470,12 +3706,15 @@ class ColorByNumberApp:
             self.start_recording()
 
     def start_recording(self):
-        if not self.display_image:
+        if not self.regions:
             messagebox.showwarning("Warning", "Please generate a template first!")
             return
 
+        self.discard_recording()
         self.is_recording = True
-        self.recorded_frames = []
+        self.recording = FillRecording(self.compositor, self.regions, self.registry.flags)
+        if self.live_encode.get():
+            self.start_live_encode()
         self.record_start_time = time.time()
 
         self.rec_btn.configure(text="⏹ Stop")
@@ -1490,24 +3729,73 @@ class ColorByNumberApp:
 
     def stop_recording(self):
         self.is_recording = False
+        self.finish_live_encode()
 
         self.rec_btn.configure(text="🔴 Record")
-        self.save_video_btn.configure(state="normal" if self.recorded_frames else "disabled")
+        self.save_video_btn.configure(state="normal" if self.recording else "disabled")
 
+        frame_count = self.recording.frame_count if self.recording else 0
         duration = time.time() - self.record_start_time if self.record_start_time else 0
         self.rec_status.configure(
-            text=f"Recorded {len(self.recorded_frames)} frames ({duration:.1f}s)",
+            text=f"Recorded {frame_count} frames ({duration:.1f}s)",
             text_color=self.colors['text_dim']
         )
-        self.set_status(f"Recording stopped: {len(self.recorded_frames)} frames", "info")
+        self.set_status(f"Recording stopped: {frame_count} frames", "info")
 
-    def capture_frame(self):
-        if self.is_recording and self.display_image:
-            frame = self.display_image.copy()
-            self.recorded_frames.append(frame)
+    def capture_frame(self, hold=1):
+        """Add hold frames showing the current coloring to the recording"""
+        if self.is_recording and self.recording:
+            events = self.recording.capture(self.registry.flags, self.color_palette, hold)
+            if self.video_encoder:
+                self.video_encoder.submit(events, hold)
+
+    def video_settings(self):
+        return int(self.fps_var.get()), self.rec_resolution_var.get(), self.rec_quality_var.get()
+
+    def start_live_encode(self):
+        """Open a writer on a temp file and encode captures as they arrive"""
+        fps = int(self.fps_var.get())
+        res = self._parse_resolution_choice(self.rec_resolution_var.get())
+        src_h, src_w = self.recording.start_frame.shape[:2]
+
+        fd, path = tempfile.mkstemp(suffix=".mp4", prefix="coloring_")
+        os.close(fd)
+        try:
+            writer, size, _used_codec = self._make_video_writer(path, fps, res or (src_w, src_h))
+        except RuntimeError as e:
+            os.remove(path)
+            self.set_status(f"Live encoding unavailable: {str(e)}", "warning")
+            return
+
+        geometry = FrameGeometry((src_w, src_h), size, letterbox=res is not None)
+        self.video_encoder = VideoEncoder(writer, self.recording, geometry)
+        self.live_video = {'path': path, 'settings': self.video_settings()}
+
+    def finish_live_encode(self):
+        if not self.video_encoder:
+            return
+        encoder, self.video_encoder = self.video_encoder, None
+        try:
+            encoder.close()
+        except Exception as e:
+            self.remove_live_video()
+            self.set_status(f"Live encoding failed, will encode on save: {str(e)}", "warning")
+
+    def remove_live_video(self):
+        if self.live_video:
+            try:
+                os.remove(self.live_video['path'])
+            except OSError:
+                pass
+            self.live_video = None
+
+    def discard_recording(self):
+        self.finish_live_encode()
+        self.remove_live_video()
+        self.recording = None
 
     def save_video(self):
-        if not self.recorded_frames:
+        if not self.recording:
             messagebox.showwarning("Warning", "No frames recorded!")
             return
 
@@ -1529,13 +3817,22 @@ class ColorByNumberApp:
             self.root.config(cursor="wait")
             self.root.update()
 
+            stats = None
             if file_path.lower().endswith('.gif'):
-                self.save_as_gif(file_path)
+                stats = self.save_as_gif(file_path)
+            elif (self.live_video and not self.is_recording and file_path.lower().endswith('.mp4')
+                    and self.live_video['settings'] == self.video_settings()):
+                shutil.copyfile(self.live_video['path'], file_path)
             else:
-                self.save_as_video(file_path)
+                stats = self.save_as_video(file_path)
 
             self.root.config(cursor="")
-            self.set_status(f"Video saved: {file_path}", "success")
+            if stats:
+                written, elapsed = stats
+                self.set_status(f"Video saved: {file_path} ({written} frames, "
+                                f"{written / max(elapsed, 1e-9):.0f} fps)", "success")
+            else:
+                self.set_status(f"Video saved: {file_path}", "success")
             messagebox.showinfo("Success", f"Video saved to {file_path}")
 
         except Exception as e:
@@ -1551,23 +3848,6 @@ class ColorByNumberApp:
             return None
         return int(m.group(1)), int(m.group(2))
 
-    def _resize_with_letterbox(self, img: Image.Image, target_w: int, target_h: int, fill=(255, 255, 255)):
-        img = img.convert("RGB")
-        src_w, src_h = img.size
-        if src_w <= 0 or src_h <= 0:
-            return Image.new("RGB", (target_w, target_h), fill)
-
-        scale = min(target_w / src_w, target_h / src_h)
-        new_w = max(1, int(round(src_w * scale)))
-        new_h = max(1, int(round(src_h * scale)))
-
-        resized = img.resize((new_w, new_h), Image.LANCZOS)
-        out = Image.new("RGB", (target_w, target_h), fill)
-        ox = (target_w - new_w) // 2
-        oy = (target_h - new_h) // 2
-        out.paste(resized, (ox, oy))
-        return out
-
     def _quality_value(self):
         q = (self.rec_quality_var.get() or "High").strip().lower()
         return {
@@ -1619,41 +3899,40 @@ class ColorByNumberApp:
 
         raise RuntimeError(f"Could not open VideoWriter for {file_path} (last={last})")
 
+    def export_workers(self):
+        choice = self.export_workers_var.get()
+        return int(choice) if choice.isdigit() else None
+
     def save_as_video(self, file_path):
-        if not self.recorded_frames:
-            return
+        """Encode the recording; returns (frames written, seconds)"""
+        if not self.recording:
+            return 0, 0.0
 
         fps = int(self.fps_var.get())
 
         choice = self.rec_resolution_var.get()
         res = self._parse_resolution_choice(choice)
 
-        first = self.recorded_frames[0].convert("RGB")
-        if res is None:
-            out_w, out_h = first.size
-        else:
-            out_w, out_h = res
+        src_h, src_w = self.recording.start_frame.shape[:2]
+        out, size, _used_codec = self._make_video_writer(file_path, fps, res or (src_w, src_h))
+        geometry = FrameGeometry((src_w, src_h), size, letterbox=res is not None)
 
-        out, (out_w, out_h), _used_codec = self._make_video_writer(file_path, fps, (out_w, out_h))
+        def prepare(frame):
+            return geometry.apply(frame, geometry.new_canvas())
 
-        try:
-            for frame in self.recorded_frames:
-                img = frame.convert("RGB")
-                if res is None:
-                    if img.size != (out_w, out_h):
-                        img = img.resize((out_w, out_h), Image.LANCZOS)
-                else:
-                    img = self._resize_with_letterbox(img, out_w, out_h, fill=(255, 255, 255))
+        def write(video_frame, hold):
+            for _ in range(hold):
+                out.write(video_frame)
 
-                frame_rgb = np.array(img, dtype=np.uint8)
-                frame_bgr = cv2.cvtColor(frame_rgb, cv2.COLOR_RGB2BGR)
-                out.write(frame_bgr)
+        try:
+            return export_frames(self.recording.iter_frames(), prepare, write, self.export_workers())
         finally:
             out.release()
 
     def save_as_gif(self, file_path):
-        if not self.recorded_frames:
-            return
+        """Write the recording as a GIF; returns (frames written, seconds)"""
+        if not self.recording:
+            return 0, 0.0
 
         fps = int(self.fps_var.get())
         duration = int(1000 / max(1, fps))
@@ -1661,31 +3940,30 @@ class ColorByNumberApp:
         choice = self.rec_resolution_var.get()
         res = self._parse_resolution_choice(choice)
 
-        frames = []
-        for frame in self.recorded_frames:
-            img = frame.convert("RGB")
-
-            if res is not None:
-                tw, th = res
-                img = self._resize_with_letterbox(img, tw, th, fill=(255, 255, 255))
-            else:
-                max_size = 800
-                if max(img.size) > max_size:
-                    ratio = max_size / max(img.size)
-                    new_size = (int(img.width * ratio), int(img.height * ratio))
-                    img = img.resize(new_size, Image.LANCZOS)
-
-            img = img.convert('P', palette=Image.ADAPTIVE, colors=256)
-            frames.append(img)
-
-        frames[0].save(
-            file_path,
-            save_all=True,
-            append_images=frames[1:],
-            duration=duration,
-            loop=0,
-            optimize=False
-        )
+        src_h, src_w = self.recording.start_frame.shape[:2]
+        if res is not None:
+            geometry = FrameGeometry((src_w, src_h), res, bgr=False)
+        else:
+            max_size = 800
+            ratio = min(1.0, max_size / max(src_w, src_h))
+            geometry = FrameGeometry((src_w, src_h), (int(src_w * ratio), int(src_h * ratio)),
+                                     letterbox=False, bgr=False)
+
+        fill_colors = set(self.color_palette.values())
+        fill_colors.update(color for _, _, color in self.recording.events if color is not None)
+        palette, lut = build_gif_palette(sorted(fill_colors))
+
+        def prepare(frame):
+            return np.take(lut, gif_codes(geometry.apply(frame, geometry.new_canvas())))
+
+        with open(file_path, 'wb') as fp:
+            writer = GifWriter(fp, palette, geometry.out_size)
+            stats = export_frames(
+                self.recording.iter_frames(), prepare,
+                lambda indices, hold: writer.add(indices, duration * hold), self.export_workers()
+            )
+            writer.close()
+        return stats
 
     def record_full_animation(self):
         if not self.regions:
@@ -1696,140 +3974,126 @@ class ColorByNumberApp:
             "Record Animation",
             "This will clear current progress and record the full coloring animation. Continue?"
         ):
-            self.colored_regions = {}
-            self.display_image = self.template_image.copy()
+            self.set_colored_regions({})
+            self.framebuffer.load(self.template_image)
             self.update_canvas()
             self.update_progress()
 
             self.start_recording()
 
-            for _ in range(self.fps_var.get()):
-                self.capture_frame()
+            self.capture_frame(hold=self.fps_var.get())
 
             self.start_animation()
 
     # ==================== Canvas & Display Methods ====================
 
     def update_canvas(self):
-        if not self.display_image:
+        if not self.framebuffer:
             return
 
-        width = int(self.display_image.width * self.zoom_level)
-        height = int(self.display_image.height * self.zoom_level)
-
-        resized = self.display_image.resize((width, height), Image.NEAREST)
-
-        self.photo = ImageTk.PhotoImage(resized)
-
-        self.canvas.delete("all")
-        self.canvas.create_image(self.pan_offset[0], self.pan_offset[1],
-                                 anchor=tk.NW, image=self.photo)
-
-        self.canvas.config(scrollregion=self.canvas.bbox("all"))
+        self.tile_renderer.render(self.framebuffer, self.zoom_level, self.pan_offset)
 
     def update_progress(self):
         if not self.regions:
             return
 
-        total_regions = len(self.regions)
-        colored_regions = len(self.colored_regions)
+        total_regions = len(self.registry)
+        colored_regions = self.registry.done_count
 
         progress = (colored_regions / total_regions) if total_regions > 0 else 0
         self.progress_bar.set(progress)
         self.progress_label.configure(text=f"{progress*100:.1f}% ({colored_regions}/{total_regions})")
 
-    def update_palette_progress(self):
-        color_progress = defaultdict(lambda: {'total': 0, 'done': 0})
-
-        for region_id, region_info in self.regions.items():
-            color_num = region_info['color_num']
-            color_progress[color_num]['total'] += 1
-            if region_id in self.colored_regions:
-                color_progress[color_num]['done'] += 1
-
-        for num, widgets in self.palette_buttons.items():
-            progress = color_progress[num]
-            if progress['total'] > 0:
-                if progress['done'] == progress['total']:
+    def update_palette_progress(self, color_nums=None):
+        """Refresh the progress marks of the given colors, or of every color"""
+        if color_nums is None:
+            color_nums = self.palette_buttons.keys()
+
+        for num in color_nums:
+            widgets = self.palette_buttons.get(num)
+            total = self.registry.total.get(num, 0)
+            done = self.registry.done(num)
+            if widgets and total > 0:
+                if done == total:
                     widgets['progress'].configure(text="✓", text_color=self.colors['success'])
-                elif progress['done'] > 0:
+                elif done > 0:
                     widgets['progress'].configure(text="◐", text_color=self.colors['warning'])
                 else:
                     widgets['progress'].configure(text="○", text_color="gray")
 
     def check_completion(self):
-        return self.regions is not None and len(self.colored_regions) == len(self.regions)
+        return self.regions is not None and self.registry.done_count == len(self.registry)
 
     def on_completion(self):
         self.stop_animation()
 
         if self.is_recording:
-            for _ in range(self.fps_var.get() * 2):
-                self.capture_frame()
+            self.capture_frame(hold=self.fps_var.get() * 2)
             self.stop_recording()
 
         self.set_status("🎉 Coloring complete!", "success")
-        messagebox.showinfo("🎉 Congratulations!",
-                            f"You completed the coloring!\n\nRecorded {len(self.recorded_frames)} frames.")
+        message = "You completed the coloring!"
+        if self.recording:
+            message += f"\n\nRecorded {self.recording.frame_count} frames."
+        messagebox.showinfo("🎉 Congratulations!", message)
 
     # ==================== History & Tools ====================
 
-    def save_state(self):
-        if self.history_index < len(self.history) - 1:
-            self.history = self.history[:self.history_index + 1]
-
-        state = {
-            'colored_regions': self.colored_regions.copy(),
-            'display_image': self.display_image.copy()
-        }
-        self.history.append(state)
-        self.history_index = len(self.history) - 1
-
     def undo(self):
-        if self.history_index > 0:
-            self.history_index -= 1
-            state = self.history[self.history_index]
-            self.colored_regions = state['colored_regions'].copy()
-            self.display_image = state['display_image'].copy()
-            self.update_canvas()
-            self.update_progress()
-            self.update_palette_progress()
-            self.set_status("Undo", "info")
+        entry = self.history.undo()
+        if entry is None:
+            return
+
+        kind, payload = entry
+        if kind == 'fill':
+            self.unfill_region(payload)
+        else:
+            flags = FillHistory.unpack(payload)
+            colored = {int(r): int(self.regions.color_nums[r]) for r in np.flatnonzero(flags)}
+            changed = self.set_colored_regions(colored)
+            self.framebuffer.load(self.compositor.template_view(self.registry.flags))
+            self.update_palette_progress(changed)
+        self.update_canvas()
+        self.update_progress()
+        self.set_status("Undo", "info")
 
     def redo(self):
-        if self.history_index < len(self.history) - 1:
-            self.history_index += 1
-            state = self.history[self.history_index]
-            self.colored_regions = state['colored_regions'].copy()
-            self.display_image = state['display_image'].copy()
-            self.update_canvas()
-            self.update_progress()
-            self.update_palette_progress()
-            self.set_status("Redo", "info")
+        entry = self.history.redo()
+        if entry is None:
+            return
+
+        kind, payload = entry
+        if kind == 'fill':
+            self.fill_region(payload, save_history=False)
+        else:
+            changed = self.set_colored_regions({})
+            self.framebuffer.load(self.template_image)
+            self.update_palette_progress(changed)
+        self.update_canvas()
+        self.update_progress()
+        self.set_status("Redo", "info")
 
     def clear_all(self):
         if messagebox.askyesno("Confirm", "Clear all colored regions?"):
             self.stop_animation()
-            self.colored_regions = {}
+            if len(self.registry):
+                self.history.record_clear(self.registry.flags)
+            changed = self.set_colored_regions({})
             if self.template_image:
-                self.display_image = self.template_image.copy()
+                self.framebuffer.load(self.template_image)
             self.update_canvas()
             self.update_progress()
-            self.update_palette_progress()
-            self.history = []
-            self.history_index = -1
+            self.update_palette_progress(changed)
             self.set_status("Cleared all regions", "info")
 
     def show_hint(self):
         if not self.regions:
             return
 
-        uncolored = [r for r in self.regions if r not in self.colored_regions]
+        region_id = self.registry.random_uncolored()
 
-        if uncolored:
-            region_id = random.choice(uncolored)
-            region_info = self.regions[region_id]
-            color_num = region_info['color_num']
+        if region_id is not None:
+            color_num = self.regions.color_num(region_id)
 
             self.select_color(color_num)
             self.flash_hint(region_id)
@@ -1838,35 +4102,31 @@ class ColorByNumberApp:
             messagebox.showinfo("Hint", "All regions are colored!")
 
     def flash_hint(self, region_id):
-        region_info = self.regions[region_id]
-        color_num = region_info['color_num']
+        color_num = self.regions.color_num(region_id)
         color = self.color_palette[color_num]
+        slices, mask = self.regions.mask(region_id)
 
-        original = self.display_image.copy()
+        original = self.framebuffer.read(slices, mask)
+        light_color = tuple(min(255, c + 80) for c in color)
 
         for i in range(4):
-            if i % 2 == 0:
-                img_array = np.array(self.display_image)
-                mask = region_info['mask']
-                light_color = [min(255, c + 80) for c in color]
-                img_array[mask] = light_color
-                self.display_image = Image.fromarray(img_array)
-            else:
-                self.display_image = original.copy()
-
+            self.framebuffer.paint(slices, mask, light_color if i % 2 == 0 else original)
             self.update_canvas()
             self.root.update()
             time.sleep(0.15)
 
-        self.display_image = original
+        self.framebuffer.paint(slices, mask, original)
         self.update_canvas()
 
     # ==================== View Controls ====================
 
     def zoom(self, factor):
-        new_zoom = self.zoom_level * factor
-        if 0.2 <= new_zoom <= 5.0:
-            self.zoom_level = new_zoom
+        current = nearest_zoom_index(self.zoom_level)
+        index = nearest_zoom_index(self.zoom_level * factor)
+        if index == current:
+            index += 1 if factor > 1 else -1
+        if 0 <= index < len(ZOOM_LEVELS):
+            self.zoom_level = ZOOM_LEVELS[index]
             self.zoom_label.configure(text=f"Zoom: {int(self.zoom_level * 100)}%")
             self.update_canvas()
 
@@ -1887,7 +4147,10 @@ class ColorByNumberApp:
             self.pan_offset[0] += dx
             self.pan_offset[1] += dy
             self.drag_start = (event.x, event.y)
-            self.update_canvas()
+            if self.framebuffer and self.tile_renderer.zoom == self.zoom_level:
+                self.tile_renderer.pan(self.framebuffer, self.pan_offset, dx, dy)
+            else:
+                self.update_canvas()
 
     def end_pan(self, event):
         self.is_panning = False
@@ -1916,7 +4179,8 @@ class ColorByNumberApp:
                 data = {
                     'colored_regions': {str(k): v for k, v in self.colored_regions.items()},
                     'color_palette': {str(k): list(v) for k, v in self.color_palette.items()},
-                    'num_colors': self.num_colors
+                    'num_colors': self.num_colors,
+                    'generation_params': self.get_generation_params()
                 }
 
                 with open(file_path, 'w') as f:
@@ -1925,8 +4189,11 @@ class ColorByNumberApp:
                 base_path = file_path.rsplit('.', 1)[0]
                 if self.original_image:
                     self.original_image.save(f"{base_path}_original.png")
-                if self.display_image:
-                    self.display_image.save(f"{base_path}_progress.png")
+                if self.framebuffer:
+                    self.framebuffer.image().save(f"{base_path}_progress.png")
+                if self.region_labels is not None:
+                    # Region ids depend on these labels, which a later run may not reproduce
+                    Image.fromarray(self.region_labels.astype(np.uint8)).save(f"{base_path}_labels.png")
 
                 self.set_status("Progress saved!", "success")
                 messagebox.showinfo("Success", "Progress saved!")
@@ -1951,28 +4218,35 @@ class ColorByNumberApp:
                     self.original_image = Image.open(original_path).convert("RGB")
                     self.update_preview()
 
-                    self.color_palette = {int(k): tuple(v) for k, v in data['color_palette'].items()}
+                    saved_palette = {int(k): tuple(v) for k, v in data['color_palette'].items()}
                     self.num_colors = data['num_colors']
                     self.color_count_var.set(self.num_colors)
-
-                    self.generate_template()
-
-                    self.colored_regions = {int(k): v for k, v in data['colored_regions'].items()}
-
-                    for region_id in self.colored_regions:
-                        if region_id in self.regions:
-                            region_info = self.regions[region_id]
-                            color = self.color_palette[region_info['color_num']]
-                            img_array = np.array(self.display_image)
-                            img_array[region_info['mask']] = color
-                            self.display_image = Image.fromarray(img_array)
-
-                    self.update_canvas()
-                    self.update_progress()
-                    self.update_palette_progress()
-
-                    self.set_status("Progress loaded!", "success")
-                    messagebox.showinfo("Success", "Progress loaded!")
+                    self.color_count_label.configure(text=str(self.num_colors))
+                    self.apply_generation_params(data.get('generation_params', {}))
+
+                    def restore_progress():
+                        # Keep any colors edited before saving
+                        if saved_palette.keys() == self.color_palette.keys():
+                            self.set_palette(saved_palette)
+                        self.set_colored_regions({int(k): v for k, v in data['colored_regions'].items()})
+                        self.framebuffer.load(self.compositor.template_view(self.registry.flags))
+
+                        self.update_canvas()
+                        self.update_progress()
+                        self.update_palette_progress()
+
+                        self.set_status("Progress loaded!", "success")
+                        messagebox.showinfo("Success", "Progress loaded!")
+
+                    labels_path = f"{base_path}_labels.png"
+                    quantize_labels = None
+                    if os.path.exists(labels_path):
+                        quantize_labels = np.array(Image.open(labels_path)).astype(np.int32)
+                        if (quantize_labels.shape != (self.original_image.height, self.original_image.width)
+                                or quantize_labels.max() >= self.num_colors):
+                            quantize_labels = None
+
+                    self.generate_template(on_done=restore_progress, quantize_labels=quantize_labels)
                 else:
                     messagebox.showerror("Error", "Original image not found!")
             except Exception as e:
@@ -1980,7 +4254,7 @@ class ColorByNumberApp:
                 messagebox.showerror("Error", f"Failed to load: {str(e)}")
 
     def export_image(self):
-        if not self.display_image:
+        if not self.framebuffer:
             messagebox.showwarning("Warning", "No image to export!")
             return
 
@@ -1991,7 +4265,7 @@ class ColorByNumberApp:
 
         if file_path:
             try:
-                self.display_image.save(file_path)
+                self.framebuffer.image().save(file_path)
                 self.set_status(f"Exported to {file_path}", "success")
                 messagebox.showinfo("Success", f"Image exported to {file_path}")
             except Exception as e:
@@ -2066,11 +4340,14 @@ def main():
         "• Ctrl+Z: Undo\n"
         "• Ctrl+Y: Redo\n"
         "• Scroll: Zoom\n"
-        "• Right-drag: Pan"
+        "• Right-drag: Pan\n"
+        "• Right-click a palette color: Edit it"
     ))
 
     root.mainloop()
+    app.discard_recording()  # removes a live-encoded temp file
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # worker processes of frozen builds
     main()
\ No newline at end of file